@@ -0,0 +1,107 @@
+import numpy as np
+from sklearn.base import BaseEstimator, ClassifierMixin
+
+
+class BlockedKNeighborsClassifier(BaseEstimator, ClassifierMixin):
+    def __init__(self, n_neighbors: int = 5, weights: str = 'uniform', normalize: bool = False, memory_budget: int = 256 * 2 ** 20):
+        """ Euclidean KNN classifier computing distances with blocked matrix products
+
+        Training features are kept in one contiguous float32 block together with their squared norms,
+        so the distances of a block of queries are ‖a‖² - 2abᵀ + ‖b‖², one GEMM per block.
+        The k nearest are picked with argpartition instead of a full sort.
+
+        # Arguments
+            n_neighbors: int
+                number of neighbours that vote
+            weights: str
+                'uniform' or 'distance' (inverse distance) votes
+            normalize: bool
+                whether to L2-normalize features, which turns euclidean into cosine ordering
+            memory_budget: int
+                bytes available for one block of the query x train distance matrix
+        """
+        self.n_neighbors = n_neighbors
+        self.weights = weights
+        self.normalize = normalize
+        self.memory_budget = memory_budget
+
+    def prepare(self, X: np.ndarray) -> np.ndarray:
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if self.normalize:
+            X = X / np.maximum(np.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+        return X
+
+    def fit(self, X: np.ndarray, y: np.ndarray):
+        self.X_ = self.prepare(X)
+        self.squared_norms_ = np.einsum('ij,ij->i', self.X_, self.X_)
+        self.classes_, self.y_index_ = np.unique(y, return_inverse=True)
+        return self
+
+    def block_rows(self) -> int:
+        # per query x train entry: the float32 GEMM output, updated in place into the distances,
+        # and the intp index array argpartition allocates
+        return max(1, self.memory_budget // ((4 + np.dtype(np.intp).itemsize) * self.X_.shape[0]))
+
+    def kneighbors(self, X: np.ndarray = None, n_neighbors: int = None) -> (np.ndarray, np.ndarray):
+        """ Distances and indices of the nearest training samples, sorted by distance.
+
+        X=None queries the training set itself with every sample excluded from its own neighbours.
+        """
+        exclude_self = X is None
+        query = self.X_ if exclude_self else self.prepare(X)
+        query_norms = self.squared_norms_ if exclude_self else np.einsum('ij,ij->i', query, query)
+        k = min(n_neighbors or self.n_neighbors, self.X_.shape[0] - exclude_self)
+
+        distances = np.empty((query.shape[0], k), dtype=np.float32)
+        indices = np.empty((query.shape[0], k), dtype=np.intp)
+        block = self.block_rows()
+
+        for start in range(0, query.shape[0], block):
+            end = min(start + block, query.shape[0])
+            rows = np.arange(end - start)
+
+            block_distances = query[start:end].dot(self.X_.T)
+            block_distances *= -2
+            block_distances += query_norms[start:end, np.newaxis]
+            block_distances += self.squared_norms_
+            np.maximum(block_distances, 0, out=block_distances)
+            if exclude_self:
+                block_distances[rows, rows + start] = np.inf
+
+            nearest = np.argpartition(block_distances, k - 1, axis=1)[:, :k]
+            nearest_distances = np.take_along_axis(block_distances, nearest, axis=1)
+            order = np.argsort(nearest_distances, axis=1)
+
+            indices[start:end] = np.take_along_axis(nearest, order, axis=1)
+            distances[start:end] = np.sqrt(np.take_along_axis(nearest_distances, order, axis=1))
+            # nearest is a view that keeps the whole argpartition array alive, free both blocks
+            # before the next GEMM so only one block is ever resident
+            del block_distances, nearest
+
+        return distances, indices
+
+    def vote(self, distances: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        if self.weights == 'distance':
+            # like sklearn: exact duplicates get all the weight
+            exact = distances == 0
+            with np.errstate(divide='ignore'):
+                weights = np.where(exact.any(axis=1, keepdims=True), exact, 1 / distances)
+        elif self.weights == 'uniform':
+            weights = np.ones_like(distances)
+        else:
+            raise ValueError(f"Unknown weights: {self.weights}")
+
+        rows = np.arange(indices.shape[0])[:, np.newaxis]
+        votes = np.zeros((indices.shape[0], len(self.classes_)))
+        np.add.at(votes, (rows, self.y_index_[indices]), weights)
+        return votes / votes.sum(axis=1, keepdims=True)
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        return self.vote(*self.kneighbors(X))
+
+    def predict(self, X: np.ndarray) -> np.ndarray:
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+    def predict_leave_one_out(self) -> np.ndarray:
+        """ Predictions for every training sample by its neighbours among all the others."""
+        return self.classes_[np.argmax(self.vote(*self.kneighbors()), axis=1)]
@@ -1,12 +1,15 @@
+import time
+
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy.linalg import cho_factor, cho_solve, solve_triangular
 
 from sklearn.linear_model import LinearRegression
 from sklearn.metrics import mean_squared_error
 
 
 class MyLinearRegression:
-    def __init__(self, weights_init='random', add_bias = True, learning_rate=1e-5, num_iterations=1_000, verbose=False, max_error=1e-5):
+    def __init__(self, weights_init='random', add_bias = True, learning_rate=1e-5, num_iterations=1_000, verbose=False, max_error=1e-5, batch_size=None, num_epochs=10, solver='gd', optimizer='gd', log_interval=1.0, random_state=None):
         """ Linear regression model using gradient descent
 
         # Arguments
@@ -22,6 +25,18 @@ class MyLinearRegression:
                 enabling verbose output
             max_error: float
                 error tolerance term, after reaching which we stop gradient descent iterations
+            batch_size: int
+                mini-batch size, None means full-batch gradient descent
+            num_epochs: int
+                maximum number of passes over the data in mini-batch mode
+            solver: str
+                'gd' for gradient descent, or a closed form solver ['auto', 'cholesky', 'qr', 'lstsq', 'pinv']
+            optimizer: str
+                update rule for gradient descent ['gd', 'momentum', 'adam', 'backtracking', 'exact']
+            log_interval: float
+                minimum number of seconds between verbose progress lines
+            random_state: int
+                seed of the weight initialization and mini-batch order, None draws them from np.random
         """
 
         self.num_iterations = num_iterations
@@ -30,14 +45,23 @@ class MyLinearRegression:
         self.add_bias = add_bias
         self.verbose = verbose
         self.max_error = max_error
-
+        self.batch_size = batch_size
+        self.num_epochs = num_epochs
+        self.solver = solver
+        self.optimizer = optimizer
+        self.log_interval = log_interval
+        self.random_state = random_state
+
+        self.params = None
         self.weights = None
         self.bias = None
+        self._optimizer = None
 
     def initialize_weights(self, n_features):
         """ weights initialization function """
         if self.weights_init == 'random':
-            return np.round(np.random.uniform(low=1e-6, high=1.0, size=(n_features, 1)), decimals=12)
+            rng = np.random if self.random_state is None else np.random.default_rng(self.random_state)
+            return np.round(rng.uniform(low=1e-6, high=1.0, size=(n_features, 1)), decimals=12)
         elif self.weights_init == 'zeros':
             return np.zeros((n_features, 1))
         else:
@@ -57,48 +81,478 @@ class MyLinearRegression:
         return loss
 
     def fit(self, x, y):
-        self.bias = 0
-        self.weights = self.initialize_weights(x.shape[1])
+        if self.solver != 'gd':
+            return self.fit_closed_form(x, y)
+
+        if self.batch_size is not None:
+            # one generator for the whole fit, so every epoch gets a different chunk order
+            rng = None if self.random_state is None else np.random.default_rng(self.random_state)
+            return self.fit_stream(lambda: iterate_batches(x, y, self.batch_size, random_state=rng), num_epochs=self.num_epochs)
+
+        objective = LeastSquaresObjective(x, y, self.add_bias)
+        optimizer = self._optimizer = create_optimizer(self.optimizer, self.learning_rate)
+        self.initialize_params(x.shape[1])
 
+        previous_loss = None
+        last_log = time.monotonic()
         for i in range(self.num_iterations):
-            # step 1: calculate current_loss value
-            y_pred = self.predict(x)
-            current_loss = self.cost(y, y_pred)
+            # step 1: one fused forward pass giving the current loss and its gradient
+            loss, gradient = objective.loss_and_gradient(self.params)
+
+            # step 2: stop once the loss changes less than max_error between iterations
+            if previous_loss is not None and np.abs(previous_loss - loss) < self.max_error:
+                print(f"Converged at iteration {i}")
+                break
 
-            # step 2: calculate gradient value
-            gradient = (-2 / x.shape[0]) * np.dot(x.T, (y - y_pred))
+            # step 3: let the optimizer update weights and bias in place
+            optimizer.step(self.params, gradient, loss, objective)
+            previous_loss = loss
 
-            # step 3: update weights using learning rate and gradient value
-            self.weights -= self.learning_rate * gradient
+            if self.verbose and time.monotonic() - last_log >= self.log_interval:
+                print(f"In iteration {i}, loss: {loss}")
+                last_log = time.monotonic()
+        else:
+            loss = objective.loss(self.params)
 
-            if self.add_bias:
-                self.bias -= self.learning_rate * 2 * np.mean(y_pred - y, axis=0)
+        print(f"Final loss: {loss} in iteration {i}")
 
-            # step 4: calculate new_loss value
-            new_y_pred = np.dot(x, self.weights) + self.bias
-            new_loss = self.cost(y, new_y_pred)
+    def initialize_params(self, n_features):
+        """ weights and bias share one array, so optimizers update both with one step """
+        weights = self.initialize_weights(n_features)
+        if self.add_bias:
+            weights = np.vstack([weights, np.zeros((1, weights.shape[1]))])
+        self.set_params(weights)
+
+    def set_params(self, params):
+        self.params = params
+        if self.add_bias:
+            self.weights, self.bias = self.params[:-1], self.params[-1]
+        else:
+            self.weights, self.bias = self.params, 0
+
+    def partial_fit(self, x, y):
+        """ one mini-batch optimizer step, returns the batch loss before the update """
+        if self.params is None or self._optimizer is None:
+            if self.params is None:
+                self.initialize_params(x.shape[1])
+            self._optimizer = create_optimizer(self.optimizer, self.learning_rate)
+
+        objective = LeastSquaresObjective(x, y, self.add_bias)
+        loss, gradient = objective.loss_and_gradient(self.params)
+        self._optimizer.step(self.params, gradient, loss, objective)
+        return loss
 
-            if self.verbose or i % 100 == 0:
-                print(f"In iteration {i}, new loss: {new_loss}")
+    def fit_stream(self, batches, num_epochs=1):
+        """ mini-batch gradient descent over chunks that do not have to fit in memory
 
-            # step 5:
-            # if new_loss and current_loss difference is greater than max_error -> break;
-            # if iteration is greater than max_iterations -> break
-            diff_loss = np.abs(new_loss - current_loss)
-            if diff_loss < self.max_error:
-                print(f"Converged at iteration {i}")
+            # Arguments:
+                batches: callable or iterable
+                    callable returning a fresh iterator of (x, y) chunks for every epoch,
+                    or an iterable of chunks (a one-shot generator allows only one epoch)
+                num_epochs: int
+                    maximum number of passes over the data
+        """
+        self.params = self.weights = self._optimizer = None
+        previous_loss, epoch_loss, epoch = None, None, 0
+
+        for epoch in range(num_epochs):
+            chunks = batches() if callable(batches) else batches
+            total_loss, n_samples = 0.0, 0
+            for x_batch, y_batch in chunks:
+                total_loss += self.partial_fit(x_batch, y_batch) * x_batch.shape[0]
+                n_samples += x_batch.shape[0]
+
+            if n_samples == 0:
                 break
 
-        loss = self.cost(y, np.dot(x, self.weights) + self.bias)
-        print(f"Final loss: {loss} in iteration {i}")
+            epoch_loss = total_loss / n_samples
+            if self.verbose:
+                print(f"In epoch {epoch}, loss: {epoch_loss}")
+
+            if previous_loss is not None and np.abs(epoch_loss - previous_loss) < self.max_error:
+                print(f"Converged at epoch {epoch}")
+                break
+            previous_loss = epoch_loss
+
+        print(f"Final loss: {epoch_loss} in epoch {epoch}")
+
+    def fit_closed_form(self, x, y):
+        """ exact least squares solution, streamed chunk by chunk when batch_size is set """
+        if self.batch_size is None:
+            x_fit = add_bias_column(x) if self.add_bias else x
+            weights = normal_equation(x_fit, y, solver=self.solver)
+        else:
+            solver = StreamingLeastSquares(solver=self.solver, add_bias=self.add_bias)
+            for x_batch, y_batch in iterate_batches(x, y, self.batch_size, shuffle=False):
+                solver.partial_fit(x_batch, y_batch)
+            weights = solver.solve()
+
+        # a later partial_fit continues from the solution with a fresh optimizer
+        self.set_params(weights)
+        self._optimizer = None
+
+        if self.verbose:
+            print(f"Final loss: {self.cost(y, self.predict(x))}")
 
     def predict(self, x):
         return x.dot(self.weights) + self.bias
 
 
+class LeastSquaresObjective:
+    def __init__(self, x, y, add_bias):
+        """ Mean squared error of a linear model
+
+        params hold the weights with the bias as the last row when add_bias is set.
+        """
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        if self.y.ndim == 1:
+            self.y = self.y[:, np.newaxis]
+        self.add_bias = add_bias
+
+    def forward(self, params):
+        if self.add_bias:
+            return self.x.dot(params[:-1]) + params[-1]
+        return self.x.dot(params)
+
+    def loss(self, params):
+        return np.mean((self.forward(params) - self.y) ** 2)
+
+    def loss_and_gradient(self, params):
+        residual = self.forward(params) - self.y
+        return np.mean(residual ** 2), self.gradient(residual)
+
+    def gradient(self, residual):
+        gradient = (2 / self.x.shape[0]) * self.x.T.dot(residual)
+        if self.add_bias:
+            gradient = np.vstack([gradient, 2 * np.mean(residual, axis=0, keepdims=True)])
+        return gradient
+
+    def curvature(self, direction):
+        """ directionᵀ H direction, the loss is quadratic so this is exact """
+        return (2 / self.x.shape[0]) * np.sum(self.forward(direction) ** 2)
+
+
+class GradientDescent:
+    def __init__(self, learning_rate):
+        self.learning_rate = learning_rate
+
+    def step(self, params, gradient, loss, objective):
+        params -= self.learning_rate * gradient
+
+
+class Momentum(GradientDescent):
+    def __init__(self, learning_rate, beta=0.9):
+        super().__init__(learning_rate)
+        self.beta = beta
+        self.velocity = None
+
+    def step(self, params, gradient, loss, objective):
+        if self.velocity is None:
+            self.velocity = np.zeros_like(gradient)
+        self.velocity = self.beta * self.velocity + gradient
+        params -= self.learning_rate * self.velocity
+
+
+class Adam(GradientDescent):
+    def __init__(self, learning_rate, beta1=0.9, beta2=0.999, epsilon=1e-8):
+        super().__init__(learning_rate)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.epsilon = epsilon
+        self.m = None
+        self.v = None
+        self.t = 0
+
+    def step(self, params, gradient, loss, objective):
+        if self.m is None:
+            self.m = np.zeros_like(gradient)
+            self.v = np.zeros_like(gradient)
+        self.t += 1
+        self.m = self.beta1 * self.m + (1 - self.beta1) * gradient
+        self.v = self.beta2 * self.v + (1 - self.beta2) * gradient ** 2
+        m_hat = self.m / (1 - self.beta1 ** self.t)
+        v_hat = self.v / (1 - self.beta2 ** self.t)
+        params -= self.learning_rate * m_hat / (np.sqrt(v_hat) + self.epsilon)
+
+
+class BacktrackingLineSearch(GradientDescent):
+    def __init__(self, learning_rate, shrink=0.5, c=1e-4, max_steps=50):
+        """ Armijo backtracking, the accepted step is grown again on the next iteration """
+        super().__init__(learning_rate)
+        self.shrink = shrink
+        self.c = c
+        self.max_steps = max_steps
+        self.step_size = learning_rate
+
+    def step(self, params, gradient, loss, objective):
+        gradient_norm = np.sum(gradient ** 2)
+        step_size = self.step_size / self.shrink
+        for _ in range(self.max_steps):
+            if objective.loss(params - step_size * gradient) <= loss - self.c * step_size * gradient_norm:
+                break
+            step_size *= self.shrink
+        self.step_size = step_size
+        params -= step_size * gradient
+
+
+class ExactLineSearch(GradientDescent):
+    """ steepest descent with the minimizing step along the gradient """
+
+    def step(self, params, gradient, loss, objective):
+        curvature = objective.curvature(gradient)
+        step_size = np.sum(gradient ** 2) / curvature if curvature > 0 else self.learning_rate
+        params -= step_size * gradient
+
+
+optimizers = {
+    'gd': GradientDescent,
+    'momentum': Momentum,
+    'adam': Adam,
+    'backtracking': BacktrackingLineSearch,
+    'exact': ExactLineSearch,
+}
+
+
+def create_optimizer(name, learning_rate):
+    if name not in optimizers:
+        raise ValueError(f"Unknown optimizer: {name}")
+    return optimizers[name](learning_rate)
+
+
+# the only MyLinearRegression arguments the vectorized fixed-step loop of fit_sweep honours
+sweep_params = ['learning_rate', 'weights_init', 'random_state']
+
+
+def fit_sweep(x, y, configs, num_iterations=1_000, max_error=1e-5, add_bias=True):
+    """ Fits many gradient descent configurations in one run
+
+    The weights of K configurations are the columns of one (n_features, K) matrix,
+    so every iteration is a single matmul for the forward pass and one for the gradient.
+    Each configuration stops on its own once its loss changes less than max_error;
+    converged columns are dropped from the following matmuls.
+
+    # Arguments
+        x: np.array
+            input data of shape (n_samples, n_features)
+        y: np.array
+            targets of shape (n_samples, 1)
+        configs: list
+            list of dicts with MyLinearRegression arguments from sweep_params
+            (plain gradient descent only, other optimizers and solvers need separate fit calls)
+        num_iterations: int
+            maximum number of iterations for every configuration
+        max_error: float
+            error tolerance term shared by all configurations
+        add_bias: bool
+            whether to add bias term
+
+    # Returns
+        fitted MyLinearRegression models in configs order and an array of their final losses
+    """
+    for config in configs:
+        unsupported = sorted(set(config) - set(sweep_params))
+        if unsupported:
+            raise ValueError(f"fit_sweep supports only {sweep_params}, got {unsupported}")
+
+    models = [
+        MyLinearRegression(add_bias=add_bias, num_iterations=num_iterations, max_error=max_error, **config)
+        for config in configs
+    ]
+    objective = LeastSquaresObjective(x, y, add_bias)
+
+    params = np.hstack([model.initialize_weights(x.shape[1]) for model in models])
+    if add_bias:
+        params = np.vstack([params, np.zeros((1, params.shape[1]))])
+    learning_rates = np.array([model.learning_rate for model in models])
+
+    previous_losses = np.full(len(models), np.inf)
+    active = np.ones(len(models), dtype=bool)
+
+    for i in range(num_iterations):
+        columns = np.flatnonzero(active)
+        if columns.size == 0:
+            break
+
+        current = params[:, columns]
+        residual = objective.forward(current) - objective.y
+        losses = np.mean(residual ** 2, axis=0)
+
+        converged = np.abs(previous_losses[columns] - losses) < max_error
+        previous_losses[columns] = losses
+        active[columns[converged]] = False
+
+        step = learning_rates[columns] * ~converged
+        params[:, columns] = current - step * objective.gradient(residual)
+
+    final_losses = np.mean((objective.forward(params) - objective.y) ** 2, axis=0)
+    for k, model in enumerate(models):
+        model.set_params(params[:, k:k + 1].copy())
+
+    print(f"Sweep of {len(models)} configurations finished in iteration {i}, best loss: {final_losses.min()}")
+    return models, final_losses
+
+
+def iterate_batches(x, y, batch_size, shuffle=True, random_state=None):
+    """ yields (x, y) chunks of batch_size rows
+
+        Works on memory-mapped arrays: only the current chunk is read into memory.
+        Shuffling permutes the order of the chunks, not single rows, so reads stay sequential.
+        random_state is a seed or np.random.Generator, None uses the global np.random state.
+    """
+    starts = np.arange(0, x.shape[0], batch_size)
+    if shuffle:
+        rng = np.random if random_state is None else np.random.default_rng(random_state)
+        starts = rng.permutation(starts)
+
+    for start in starts:
+        end = start + batch_size
+        yield np.asarray(x[start:end], dtype=np.float64), np.asarray(y[start:end], dtype=np.float64)
+
+
+def load_memmap(x_path, y_path):
+    """ opens .npy files created with np.save as read-only memory maps """
+    x = np.load(x_path, mmap_mode='r')
+    y = np.load(y_path, mmap_mode='r')
+    if y.ndim == 1:
+        y = y[:, np.newaxis]
+    return x, y
+
+
+
+solvers = ['auto', 'cholesky', 'qr', 'lstsq', 'pinv']
+
+# condition number of XᵀX above which the Cholesky route loses too many digits
+max_gram_condition = 1e8
+
+
+def add_bias_column(X):
+    return np.hstack([X, np.ones((X.shape[0], 1), dtype=X.dtype)])
+
+
+def gram_condition_estimate(cholesky_factor):
+    """ cheap lower bound of cond(XᵀX) from the diagonal of its Cholesky factor """
+    diagonal = np.abs(np.diag(cholesky_factor))
+    return (diagonal.max() / diagonal.min()) ** 2 if diagonal.min() > 0 else np.inf
+
+
+def solve_gram(XtX, Xty, solver='auto'):
+    """ solves XᵀX w = Xᵀy when only the accumulated Gram matrix is available """
+    if solver in ['auto', 'cholesky']:
+        try:
+            factor = cho_factor(XtX)
+            if solver == 'cholesky' or gram_condition_estimate(factor[0]) < max_gram_condition:
+                return cho_solve(factor, Xty)
+        except np.linalg.LinAlgError:
+            if solver == 'cholesky':
+                raise
+        solver = 'lstsq'
+
+    if solver == 'lstsq':
+        return np.linalg.lstsq(XtX, Xty, rcond=None)[0]
+    elif solver == 'pinv':
+        return np.linalg.pinv(XtX).dot(Xty)
+    else:
+        raise NotImplementedError(f"Solver {solver} needs the design matrix")
+
+
+def normal_equation(X, y, solver='auto'):
+    """ least squares weights without training the model
+
+        # Arguments:
+            X: np.array
+                design matrix of shape (n_samples, n_features)
+            y: np.array
+                targets of shape (n_samples,) or (n_samples, n_targets)
+            solver: str
+                one of ['auto', 'cholesky', 'qr', 'lstsq', 'pinv'];
+                'auto' uses Cholesky on XᵀX for tall well-conditioned problems,
+                QR for tall ill-conditioned ones and lstsq for rank deficient or wide ones;
+                wide problems always go to lstsq, XᵀX is singular and R is not square there
+    """
+    n_samples, n_features = X.shape
+
+    if solver not in solvers:
+        raise ValueError(f"Unknown solver: {solver}")
+    if n_samples < n_features and solver in ['auto', 'cholesky', 'qr']:
+        solver = 'lstsq'
+
+    if solver == 'auto':
+        try:
+            factor = cho_factor(X.T.dot(X))
+            if gram_condition_estimate(factor[0]) < max_gram_condition:
+                return cho_solve(factor, X.T.dot(y))
+        except np.linalg.LinAlgError:
+            pass
+        solver = 'qr'
+
+    if solver == 'cholesky':
+        return cho_solve(cho_factor(X.T.dot(X)), X.T.dot(y))
+    elif solver == 'qr':
+        Q, R = np.linalg.qr(X)
+        diagonal = np.abs(np.diag(R))
+        if diagonal.min() <= diagonal.max() * max(X.shape) * np.finfo(R.dtype).eps:
+            # rank deficient: the triangular solve would blow up
+            return np.linalg.lstsq(X, y, rcond=None)[0]
+        return solve_triangular(R, Q.T.dot(y))
+    elif solver == 'lstsq':
+        return np.linalg.lstsq(X, y, rcond=None)[0]
+    elif solver == 'pinv':
+        return np.linalg.pinv(X.T.dot(X)).dot(X.T.dot(y))
+
+
+class StreamingLeastSquares:
+    def __init__(self, solver='auto', add_bias=False):
+        """ Exact least squares from a single pass over chunks of the data
+
+        Accumulates XᵀX and Xᵀy, so memory is O(n_features²) whatever the number of rows.
+        The 'qr' solver keeps the triangular factor R and Qᵀy instead (TSQR),
+        which avoids squaring the condition number.
+
+        # Arguments
+            solver: str
+                one of ['auto', 'cholesky', 'qr', 'lstsq', 'pinv']
+            add_bias: bool
+                whether to append a column of ones to every chunk
+        """
+        if solver not in solvers:
+            raise ValueError(f"Unknown solver: {solver}")
+        self.solver = solver
+        self.add_bias = add_bias
+        self.XtX = None
+        self.Xty = None
+        self.R = None
+        self.Qty = None
+        self.n_samples = 0
+
+    def partial_fit(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if self.add_bias:
+            x = add_bias_column(x)
+        self.n_samples += x.shape[0]
+
+        if self.solver == 'qr':
+            if self.R is not None:
+                x = np.vstack([self.R, x])
+                y = np.vstack([self.Qty, y]) if y.ndim > 1 else np.concatenate([self.Qty, y])
+            Q, self.R = np.linalg.qr(x)
+            self.Qty = Q.T.dot(y)
+        else:
+            if self.XtX is None:
+                self.XtX = np.zeros((x.shape[1], x.shape[1]))
+                self.Xty = np.zeros((x.shape[1],) + y.shape[1:])
+            self.XtX += x.T.dot(x)
+            self.Xty += x.T.dot(y)
+
+        return self
 
-def normal_equation(X, y):
-    return np.linalg.pinv(X.T.dot(X)).dot(X.T.dot(y))
+    def solve(self):
+        if self.solver == 'qr':
+            return normal_equation(self.R, self.Qty, solver='qr')
+        # fewer rows than columns leave XᵀX singular, only lstsq and pinv handle that
+        solver = 'lstsq' if self.n_samples < self.XtX.shape[0] and self.solver in ['auto', 'cholesky'] else self.solver
+        return solve_gram(self.XtX, self.Xty, solver=solver)
 
 
 if __name__ == "__main__":
@@ -128,7 +582,7 @@ if __name__ == "__main__":
     print('Sklearn MSE: ', mean_squared_error(y, y_hat_sklearn))
 
     # Your linear regression model
-    my_model = MyLinearRegression(verbose=False, num_iterations=100000, learning_rate=1e-4, max_error=1e-8)
+    my_model = MyLinearRegression(verbose=False, num_iterations=100000, learning_rate=1e-4, max_error=1e-8, optimizer='exact')
     my_model.fit(x, y)
     y_hat = my_model.predict(x)
 
@@ -1,19 +1,25 @@
+import hashlib
+import json
 import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
 
 import click
 import csv
 import numpy as np
 from matplotlib import pyplot as plt
+from sklearn.base import clone
 from sklearn.metrics import accuracy_score, confusion_matrix, ConfusionMatrixDisplay
-from PIL import Image
-from sklearn.model_selection import train_test_split, KFold, StratifiedKFold
+from PIL import Image, ImageDraw
+from sklearn.model_selection import train_test_split, KFold, StratifiedKFold, LeaveOneOut, ParameterGrid
 from sklearn.linear_model import LogisticRegression
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.tree import DecisionTreeClassifier
 
-from tensorflow.keras.applications import ResNet50
-from tensorflow.keras.applications.resnet50 import preprocess_input
-from tensorflow.keras.preprocessing import image
+from knn import BlockedKNeighborsClassifier
 
 logistic_regression = "LogisticRegression"
 knn = "KNN"
@@ -22,6 +28,23 @@ decision_tree = "DecisionTree"
 simple = "Simple"
 kfold = "Kfold"
 stratified_kfold = "Stratified Kfold"
+leave_one_out = "LeaveOneOut"
+
+search_spaces = {
+    logistic_regression: {"C": [0.001, 0.01, 0.1, 1.0, 10.0]},
+    knn: {"n_neighbors": [3, 5, 7, 11, 15, 21], "weights": ['uniform', 'distance']},
+    decision_tree: {"max_depth": [3, 5, 10, 20, None], "min_samples_leaf": [1, 5, 10, 20]},
+}
+
+image_size = (256, 256)
+cache_folder = "cache"
+
+# changing the feature model or its preprocessing must change this string, it keys the feature store
+feature_version = "ResNet50-imagenet-avg|gray256-rgb224|preprocess_input"
+feature_model = None
+
+# arrays and values shared with pool workers, attached once per worker process
+shared_data = {}
 
 def convert_label(label: str) -> int:
     if label == "human":
@@ -34,56 +57,170 @@ def convert_label(label: str) -> int:
 def convert_int_label(label: int) -> str:
     return "human" if label == 0 else "animal"
 
-def load_data(image_folder: str, label_file: str) -> (np.array, np.array):
-    """ Loads images and labels from the specified folder and file."""
-    raw_data = []
+def load_labels(label_file: str) -> (list, list):
+    """ Reads image names and integer labels from the label file."""
+    image_names = []
+    labels = []
 
     with open(label_file, mode='r') as csvfile:
         reader = csv.reader(csvfile, delimiter='|')
         _ = next(reader)
         for row in reader:
-            raw_data.append({"image_name": row[0], "label": row[3]})
-
-    images = []
-    labels = []
-
-    for raw in raw_data:
-        image_name = raw["image_name"]
-        label_name = raw["label"]
-
-        label = convert_label(label_name)
-
-        image_path = image_folder+image_name
-        with Image.open(image_path) as image:
-            image_resized = image.resize(size=(256, 256))
-            image_converted = image_resized.convert('RGB')
-            image_grayscale = np.mean(np.array(image_converted), axis=2).flatten()
-            images.append(image_grayscale)
-            labels.append(label)
-
-    return images, labels
+            image_names.append(row[0])
+            labels.append(convert_label(row[3]))
+
+    return image_names, labels
+
+def load_image(image_path: str) -> np.ndarray:
+    """ Decodes one image into a flattened grayscale vector of image_size.
+
+    draft() lets the JPEG decoder downscale by 1/2, 1/4 or 1/8 while decoding,
+    so the full resolution image is never materialized before the resize.
+    """
+    with Image.open(image_path) as image:
+        image.draft('RGB', image_size)
+        image_resized = image.resize(size=image_size)
+        image_converted = image_resized.convert('RGB')
+        return np.mean(np.array(image_converted), axis=2).flatten().astype(np.uint8)
+
+def cache_key(image_folder: str, label_file: str) -> str:
+    """ Identifies a decoded dataset by image folder, label file content and image size."""
+    digest = hashlib.sha1()
+    digest.update(os.path.abspath(image_folder).encode())
+    with open(label_file, mode='rb') as f:
+        digest.update(f.read())
+    digest.update(str(image_size).encode())
+    return digest.hexdigest()[:16]
+
+def decode_images(image_paths: list, output: np.ndarray, num_workers: int = None) -> None:
+    """ Decodes images into the rows of output, in a pool of num_workers processes (1 disables the pool)."""
+    num_workers = num_workers or os.cpu_count()
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            chunksize = max(1, len(image_paths) // (num_workers * 4))
+            for i, image in enumerate(executor.map(load_image, image_paths, chunksize=chunksize)):
+                output[i] = image
+    else:
+        for i, image_path in enumerate(image_paths):
+            output[i] = load_image(image_path)
+
+def load_data(image_folder: str, label_file: str, num_workers: int = None, cache_folder: str = cache_folder) -> (np.array, list, list):
+    """ Loads images, labels and image names from the specified folder and file.
+
+    Images are returned as one (n_images, 65536) uint8 array in label file order.
+    With a cache_folder the array is decoded once into a .npy file and memory-mapped
+    read-only on later runs; cache_folder=None decodes into memory every time.
+    """
+    image_names, labels = load_labels(label_file)
+    image_paths = [image_folder + image_name for image_name in image_names]
+    shape = (len(image_paths), image_size[0] * image_size[1])
+
+    if cache_folder is None:
+        images = np.empty(shape, dtype=np.uint8)
+        decode_images(image_paths, images, num_workers)
+        return images, labels, image_names
+
+    key = cache_key(image_folder, label_file)
+    data_path = os.path.join(cache_folder, f"images_{key}.npy")
+    index_path = os.path.join(cache_folder, f"images_{key}.json")
+
+    # the index is written last, so a cache interrupted while decoding is never used
+    if not os.path.exists(index_path):
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_path = os.path.join(cache_folder, f"images_{key}.tmp.npy")
+        images = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape)
+        decode_images(image_paths, images, num_workers)
+        images.flush()
+        del images
+        os.replace(tmp_path, data_path)
+
+        with open(index_path, mode='w') as f:
+            json.dump({"image_folder": image_folder, "image_names": image_names, "labels": labels}, f)
+
+    with open(index_path, mode='r') as f:
+        index = json.load(f)
+
+    return np.load(data_path, mmap_mode='r'), index["labels"], index["image_names"]
 
 # def vectorize_images(images: list) -> np.ndarray:
 #     X = np.stack(images, axis=0)
 #     X = X.astype('float32') / 255.0
 #     return X
 
-def vectorize_images(images: list) -> np.ndarray:
-    base_model = ResNet50(weights='imagenet', include_top=False, pooling='avg')
-
-    processed_images = []
-    for img_array in images:
-        img = img_array.reshape(256, 256).astype('uint8')
-        img = Image.fromarray(img).convert('RGB')
-        img = img.resize((224, 224))
-        x = image.img_to_array(img)
-        x = np.expand_dims(x, axis=0)
-        x = preprocess_input(x)
-        features = base_model.predict(x)
-        processed_images.append(features.flatten())
-
-    X = np.stack(processed_images, axis=0)
-    return X
+def get_feature_model():
+    """ ResNet50 is built once per process and shared by every vectorize_images call."""
+    global feature_model
+    if feature_model is None:
+        # TensorFlow is imported here, pool workers fitting sklearn models never load it
+        from tensorflow.keras.applications import ResNet50
+        feature_model = ResNet50(weights='imagenet', include_top=False, pooling='avg')
+    return feature_model
+
+def embed_images(images, batch_size: int = 32) -> np.ndarray:
+    """ Runs ResNet50 on batches of batch_size grayscale images."""
+    from tensorflow.keras.applications.resnet50 import preprocess_input
+    from tensorflow.keras.preprocessing import image
+
+    base_model = get_feature_model()
+
+    features = []
+    for start in range(0, len(images), batch_size):
+        batch = []
+        for img_array in images[start:start + batch_size]:
+            img = np.asarray(img_array).reshape(image_size).astype('uint8')
+            img = Image.fromarray(img).convert('RGB')
+            img = img.resize((224, 224))
+            batch.append(image.img_to_array(img))
+
+        x = preprocess_input(np.stack(batch, axis=0))
+        features.append(np.asarray(base_model.predict_on_batch(x), dtype=np.float32))
+
+    return np.concatenate(features, axis=0).reshape(len(images), -1)
+
+def vectorize_images(images, image_names: list = None, batch_size: int = 32, cache_folder: str = cache_folder) -> np.ndarray:
+    """ Embeds images with ResNet50, reusing features stored on disk by earlier runs.
+
+    The store in cache_folder keeps one row per image name for every feature_version,
+    only images missing from it are embedded. Without image_names or cache_folder
+    every image is embedded.
+    """
+    if image_names is None or cache_folder is None:
+        return embed_images(images, batch_size)
+
+    key = hashlib.sha1(feature_version.encode()).hexdigest()[:16]
+    data_path = os.path.join(cache_folder, f"features_{key}.npy")
+    index_path = os.path.join(cache_folder, f"features_{key}.json")
+
+    stored_names = []
+    if os.path.exists(index_path):
+        with open(index_path, mode='r') as f:
+            stored_names = json.load(f)
+    rows = {name: i for i, name in enumerate(stored_names)}
+
+    missing = {}
+    for i, name in enumerate(image_names):
+        if name not in rows and name not in missing:
+            missing[name] = i
+
+    if missing:
+        new_features = embed_images([images[i] for i in missing.values()], batch_size)
+        if stored_names:
+            # the index may lag behind the data after an interrupted run, never the other way round
+            stored_features = np.load(data_path, mmap_mode='r')[:len(stored_names)]
+            new_features = np.concatenate([stored_features, new_features], axis=0)
+
+        os.makedirs(cache_folder, exist_ok=True)
+        tmp_path = os.path.join(cache_folder, f"features_{key}.tmp.npy")
+        np.save(tmp_path, new_features)
+        os.replace(tmp_path, data_path)
+
+        stored_names = stored_names + list(missing)
+        with open(index_path, mode='w') as f:
+            json.dump(stored_names, f)
+        rows = {name: i for i, name in enumerate(stored_names)}
+
+    features = np.load(data_path, mmap_mode='r')
+    return features[[rows[name] for name in image_names]]
 
 
 def validation_split(
@@ -106,32 +243,238 @@ def validation_split(
 
     return X_train, X_test, y_train, y_test
 
-def create_model(model_name: str):
+def create_model(model_name: str, **params):
+    """ Model with the tuned defaults, params override them (e.g. from successive_halving_search)."""
     if model_name == logistic_regression:
-        return LogisticRegression(
+        model = LogisticRegression(
             max_iter=5000,
             C=0.1,
             random_state=42,
             class_weight='balanced'
         )
     elif model_name == knn:
-        return KNeighborsClassifier(
+        model = BlockedKNeighborsClassifier(
             n_neighbors=7,
-            weights='distance',
-            metric='euclidean'
+            weights='distance'
         )
     elif model_name == decision_tree:
-        return DecisionTreeClassifier(
+        model = DecisionTreeClassifier(
             max_depth=10,
             min_samples_split=20,
             min_samples_leaf=10,
             random_state=42,
             class_weight='balanced'
         )
+    else:
+        raise ValueError(f"Unknown model: {model_name}")
+
+    return model.set_params(**params)
+
+
+@contextmanager
+def shared_arrays(**arrays):
+    """ Copies arrays into shared memory, yields specs for attach_shared_data and frees them on exit."""
+    segments = []
+    specs = {}
+    try:
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            segments.append(shm)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+            specs[name] = (shm.name, array.shape, array.dtype.str)
+        yield specs
+    finally:
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+
+def attach_shared_data(specs: dict, values: dict):
+    """ Worker initializer: maps shared arrays read-only without copying them."""
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        shared_data[name + "_shm"] = shm
+        shared_data[name] = array
+    shared_data.update(values)
+
+
+def evaluate_fold(model, X, y, train_index, val_index):
+    start = time.perf_counter()
+    model.fit(X[train_index], y[train_index])
+    score = model.score(X[val_index], y[val_index])
+    return score, time.perf_counter() - start
+
+
+def run_fold(model, train_index, val_index):
+    return evaluate_fold(model, shared_data["X_train"], shared_data["y_train"], train_index, val_index)
+
+
+def cross_validate(model, X_train, y_train, splitter, num_workers: int = None) -> list:
+    """ Fits one clone of model per fold, folds run in a pool of num_workers processes (1 runs them here)."""
+    splits = list(splitter.split(X_train, y_train))
+    num_workers = min(num_workers or os.cpu_count(), len(splits))
+
+    if num_workers > 1:
+        with shared_arrays(X_train=X_train) as specs, ProcessPoolExecutor(
+                max_workers=num_workers,
+                initializer=attach_shared_data,
+                initargs=(specs, {"y_train": y_train})
+        ) as executor:
+            futures = [executor.submit(run_fold, clone(model), train_index, val_index) for train_index, val_index in splits]
+            outcomes = [future.result() for future in futures]
+    else:
+        outcomes = [evaluate_fold(clone(model), X_train, y_train, train_index, val_index) for train_index, val_index in splits]
+
+    return [{"fold": i, "score": score, "seconds": seconds} for i, (score, seconds) in enumerate(outcomes)]
+
+
+def knn_leave_one_out(model, X, y) -> np.ndarray:
+    """ Leave-one-out predictions of a euclidean KNN from a single pass over pairwise distances.
+
+    Each sample is classified by its neighbours among all other samples, which is exactly
+    what refitting without it would do, so no refits are needed.
+    """
+    if not isinstance(model, BlockedKNeighborsClassifier):
+        model = BlockedKNeighborsClassifier(n_neighbors=model.n_neighbors, weights=model.weights)
+    return clone(model).fit(X, y).predict_leave_one_out()
+
+
+def logistic_leave_one_out(model, X, y) -> np.ndarray:
+    """ Approximate leave-one-out predictions of an L2 logistic regression from one fit, None if it did not converge.
+
+    Uses the one Newton step approximation of removing a sample:
+    eta_-i = eta_i + C * l'_i * h_i / (1 - C * l''_i * h_i), where h_i = x_iᵀ H⁻¹ x_i
+    and H is the Hessian of the penalized objective (the intercept is not penalized).
+    Only valid without class_weight: the step keeps the other samples' weights fixed.
+    """
+    model = clone(model).fit(X, y)
+    if np.max(model.n_iter_) >= model.max_iter:
+        # the approximation expands around the optimum, refit when it was not reached
+        return None
+
+    X = np.asarray(X, dtype=np.float64)
+
+    eta = model.decision_function(X)
+    p = 1 / (1 + np.exp(-eta))
+    target = (y == model.classes_[1]).astype(np.float64)
+    first = p - target
+    second = p * (1 - p)
+
+    penalty = np.ones(X.shape[1])
+    if model.fit_intercept:
+        X = np.hstack([X, np.ones((X.shape[0], 1))])
+        penalty = np.append(penalty, 0.0)
+
+    hessian = model.C * (X.T * second).dot(X) + np.diag(penalty)
+    leverage = np.einsum('ij,ji->i', X, np.linalg.solve(hessian, X.T))
+
+    eta_loo = eta + model.C * first * leverage / (1 - model.C * second * leverage)
+    return np.where(eta_loo > 0, model.classes_[1], model.classes_[0])
+
+
+def leave_one_out_predictions(model, X, y):
+    """ Fast leave-one-out predictions for models that have a shortcut, None for the others."""
+    if isinstance(model, BlockedKNeighborsClassifier):
+        return knn_leave_one_out(model, X, y)
+
+    euclidean = getattr(model, 'metric', None) == 'euclidean' or (getattr(model, 'metric', None) == 'minkowski' and model.p == 2)
+    if isinstance(model, KNeighborsClassifier) and euclidean and model.weights in ['uniform', 'distance']:
+        return knn_leave_one_out(model, X, y)
+
+    if (
+            isinstance(model, LogisticRegression)
+            and len(np.unique(y)) == 2
+            and getattr(model, 'penalty', 'l2') in ['l2', 'deprecated']
+            and not getattr(model, 'l1_ratio', None)
+            # balanced weights are re-estimated on every N-1 fold, which moves the unpenalized
+            # intercept far more than one Newton step predicts; those models are refit
+            and model.class_weight is None
+    ):
+        return logistic_leave_one_out(model, X, y)
+
+    return None
 
 
-def train_and_evaluate(X_train, y_train, X_test, y_test, model, strategy):
+def cross_validate_leave_one_out(model, X_train, y_train, num_workers: int = None) -> list:
+    """ Leave-one-out folds: shortcuts for KNN and logistic regression, parallel refits otherwise.
+
+    Shortcut folds share the total time evenly, since they are not computed one by one.
+    """
+    start = time.perf_counter()
+    y_pred = leave_one_out_predictions(model, X_train, y_train)
+    if y_pred is None:
+        return cross_validate(model, X_train, y_train, LeaveOneOut(), num_workers)
+
+    seconds = (time.perf_counter() - start) / len(y_train)
+    scores = (y_pred == y_train).astype(np.float64)
+    return [{"fold": i, "score": score, "seconds": seconds} for i, score in enumerate(scores)]
+
+
+def run_candidate(model_name: str, params: dict, sample_index: np.ndarray, n_folds: int) -> float:
+    X, y = shared_data["X"][sample_index], shared_data["y"][sample_index]
+    splitter = StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=42)
+    folds = cross_validate(create_model(model_name, **params), X, y, splitter, num_workers=1)
+    return np.mean([fold["score"] for fold in folds])
+
+
+def successive_halving_search(
+        model_name: str,
+        X: np.ndarray,
+        y: np.ndarray,
+        search_space: dict = None,
+        factor: int = 3,
+        n_folds: int = 3,
+        num_workers: int = None,
+        random_state: int = 42
+) -> (dict, list):
+    """ Picks create_model params by successive halving over search_spaces[model_name].
+
+    Every round scores the remaining candidates with n_folds cross-validation on a stratified
+    subset, keeps the best 1/factor of them and grows the subset factor times, so only the
+    last few candidates ever see all the samples. Candidates are scored in a pool of
+    num_workers processes sharing X. Returns the best params and the score history.
+    """
+    candidates = list(ParameterGrid(search_space or search_spaces[model_name]))
+    n_rounds = max(1, math.ceil(math.log(len(candidates), factor)))
+    n_samples = max(len(y) // factor ** (n_rounds - 1), min(len(y), n_folds * 10))
+
+    history = []
+    with shared_arrays(X=X) as specs, ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=attach_shared_data,
+            initargs=(specs, {"y": y})
+    ) as executor:
+        for round_index in range(n_rounds):
+            if round_index == n_rounds - 1:
+                # n_samples is rounded down, the final candidates must still see every sample
+                n_samples = len(y)
+            if n_samples < len(y):
+                sample_index, _ = train_test_split(
+                    np.arange(len(y)), train_size=n_samples, random_state=random_state, stratify=y
+                )
+            else:
+                sample_index = np.arange(len(y))
+
+            futures = [executor.submit(run_candidate, model_name, params, sample_index, n_folds) for params in candidates]
+            scores = np.array([future.result() for future in futures])
+            history.extend({"round": round_index, "samples": len(sample_index), "params": params, "score": score}
+                           for params, score in zip(candidates, scores))
+            print(f"Round {round_index}: {len(candidates)} candidates on {len(sample_index)} samples, best score {scores.max():.2f}")
+
+            order = np.argsort(-scores, kind='stable')
+            candidates = [candidates[i] for i in order[:math.ceil(len(candidates) / factor)]]
+            n_samples = min(n_samples * factor, len(y))
+
+    return candidates[0], history
+
+
+def train_and_evaluate(X_train, y_train, X_test, y_test, model, strategy, num_workers: int = None):
+    """ Returns test accuracy, test predictions and per fold validation scores and timings."""
     y_pred = None
+    folds = []
     if strategy == simple:
         X_train_sub, X_val, y_train_sub, y_val = validation_split(X_train, y_train)
         model.fit(X_train_sub, y_train_sub)
@@ -143,44 +486,54 @@ def train_and_evaluate(X_train, y_train, X_test, y_test, model, strategy):
         else:
             kf = StratifiedKFold(n_splits=k, shuffle=True, random_state=42)
 
-        scores = []
-        for train_index, val_index in kf.split(X_train, y_train):
-            X_train_fold, X_val_fold = X_train[train_index], X_train[val_index]
-            y_train_fold, y_val_fold = y_train[train_index], y_train[val_index]
+        folds = cross_validate(model, X_train, y_train, kf, num_workers)
 
-            model.fit(X_train_fold, y_train_fold)
-            score = model.score(X_val_fold, y_val_fold)
-            scores.append(score)
+        model.fit(X_train, y_train)
+        y_pred = model.predict(X_test)
+    elif strategy == leave_one_out:
+        folds = cross_validate_leave_one_out(model, X_train, y_train, num_workers)
 
         model.fit(X_train, y_train)
         y_pred = model.predict(X_test)
 
     accuracy = accuracy_score(y_test, y_pred)
-    return accuracy, y_pred
+    return accuracy, y_pred, folds
 
 
-def error_analysis(X_test, y_test, y_pred, images, model_name, validation_strategy):
-    misclassified_indices = np.where(y_test != y_pred)[0]
-    num_misclassified = len(misclassified_indices)
-    print(f"Number of misclassified labels: {num_misclassified}")
+def render_montage(images, captions: list, path: str, cols: int = 10, thumbnail_size: tuple = (96, 96)) -> None:
+    """ Tiles grayscale image vectors into one image with a caption under every thumbnail."""
+    caption_height = 24
+    rows = math.ceil(len(images) / cols)
+    tile_width, tile_height = thumbnail_size[0], thumbnail_size[1] + caption_height
 
-    cols = 5
-    rows = math.ceil(num_misclassified / cols)
+    atlas = Image.new('L', (cols * tile_width, rows * tile_height), color=255)
+    draw = ImageDraw.Draw(atlas)
+    for i, (img_array, caption) in enumerate(zip(images, captions)):
+        x, y = (i % cols) * tile_width, (i // cols) * tile_height
+        thumbnail = Image.fromarray(np.asarray(img_array, dtype=np.uint8).reshape(image_size))
+        atlas.paste(thumbnail.resize(thumbnail_size, Image.BILINEAR), (x, y))
+        draw.multiline_text((x + 2, y + thumbnail_size[1] + 1), caption, fill=0, spacing=1)
 
-    plt.figure(figsize=(cols * 3, rows * 3))
+    atlas.save(path)
 
-    for i, idx in enumerate(misclassified_indices):
-        plt.subplot(rows, cols, i + 1)
-        image = images[idx].reshape(256, 256)
-        plt.imshow(image, cmap='gray')
-        true_label = convert_int_label(y_test[idx])
-        predicted_label = convert_int_label(y_pred[idx])
-        plt.title(f"True: {true_label}\nPred: {predicted_label}", fontsize=10)
-        plt.axis('off')
 
-    plt.tight_layout()
-    plt.savefig(f"part2/{model_name}_{validation_strategy}_analysis.png")
-    plt.close()
+def error_analysis(X_test, y_test, y_pred, images, model_name, validation_strategy, max_tiles: int = 200, tiles_per_page: int = 50):
+    """ Saves montages of up to max_tiles misclassified images, tiles_per_page per file, and the confusion matrix."""
+    misclassified_indices = np.where(y_test != y_pred)[0]
+    num_misclassified = len(misclassified_indices)
+    print(f"Number of misclassified labels: {num_misclassified}")
+
+    shown_indices = misclassified_indices[:max_tiles]
+    for page, start in enumerate(range(0, len(shown_indices), tiles_per_page)):
+        page_indices = shown_indices[start:start + tiles_per_page]
+        captions = [
+            f"True: {convert_int_label(y_test[idx])}\nPred: {convert_int_label(y_pred[idx])}" for idx in page_indices
+        ]
+        suffix = "" if page == 0 else f"_{page}"
+        render_montage(
+            [images[idx] for idx in page_indices], captions,
+            f"part2/{model_name}_{validation_strategy}_analysis{suffix}.png"
+        )
 
     cm = confusion_matrix(y_test, y_pred)
     disp = ConfusionMatrixDisplay(confusion_matrix=cm, display_labels=['human', 'animal'])
@@ -195,25 +548,38 @@ def error_analysis(X_test, y_test, y_pred, images, model_name, validation_strate
 @click.option("--model_name", type=str, help="Name of the model to use")
 @click.option("--test_size", type=float, default=0.2, help="Size of the test split")
 @click.option("--validation_strategy", help="Validation strategy to use")
-def main(image_folder: str, label_file: str, model_name: str, test_size: float, validation_strategy: str):
-    main_internal(image_folder, label_file, model_name, test_size, validation_strategy)
+@click.option("--num_workers", type=int, default=None, help="Number of image decoding processes")
+@click.option("--search", is_flag=True, help="Tune model hyperparameters with successive halving")
+def main(image_folder: str, label_file: str, model_name: str, test_size: float, validation_strategy: str, num_workers: int, search: bool):
+    main_internal(image_folder, label_file, model_name, test_size, validation_strategy, num_workers, search)
 
 
-def main_internal(image_folder: str, label_file: str, model_name: str, test_size: float, validation_strategy: str):
-    # Create dataset of image <-> label pairs
-    images, labels = load_data(image_folder, label_file)
-
-    # preprocess images and labels
-    X = vectorize_images(images)
+def prepare_data(image_folder: str, label_file: str, test_size: float, num_workers: int = None):
+    """ Loads and vectorizes the dataset and splits row indices into train and test."""
+    images, labels, image_names = load_data(image_folder, label_file, num_workers)
+    X = vectorize_images(images, image_names)
     y = np.array(labels)
 
-    # split data into train and test
-    X_train, X_test, y_train, y_test, images_train, images_test = train_test_split(
-        X, y, images, test_size=test_size, random_state=42, stratify=y
+    train_index, test_index = train_test_split(
+        np.arange(len(y)), test_size=test_size, random_state=42, stratify=y
     )
+    return X, y, images, train_index, test_index
+
 
-    # create model
-    model = create_model(model_name)
+def main_internal(image_folder: str, label_file: str, model_name: str, test_size: float, validation_strategy: str, num_workers: int = None, search: bool = False):
+    # Create dataset of image <-> label pairs, preprocess images and labels
+    # and split data into train and test
+    X, y, images, train_index, test_index = prepare_data(image_folder, label_file, test_size, num_workers)
+    X_train, X_test = X[train_index], X[test_index]
+    y_train, y_test = y[train_index], y[test_index]
+    images_test = images[test_index]
+
+    # create model, optionally tuning its hyperparameters on the train data first
+    params = {}
+    if search:
+        params, _ = successive_halving_search(model_name, X_train, y_train, num_workers=num_workers)
+        print(f"Best params for {model_name}: {params}")
+    model = create_model(model_name, **params)
 
     # Train model using different validation strategies (refere to https://scikit-learn.org/stable/modules/cross_validation.html)
     # 1. Train, validation, test splits: so you need to split train into train and validation
@@ -222,8 +588,13 @@ def main_internal(image_folder: str, label_file: str, model_name: str, test_size
 
     # Make a prediction on test data
     # Calculate accuracy
-    accuracy, y_pred = train_and_evaluate(X_train, y_train, X_test, y_test, model, validation_strategy)
+    accuracy, y_pred, folds = train_and_evaluate(X_train, y_train, X_test, y_test, model, validation_strategy, num_workers)
     print(f"Accuracy {validation_strategy} {model_name}: {accuracy:.2f}")
+    if validation_strategy == leave_one_out:
+        print(f"Leave-one-out accuracy: {np.mean([fold['score'] for fold in folds]):.2f}")
+    else:
+        for fold in folds:
+            print(f"Fold {fold['fold']}: validation accuracy {fold['score']:.2f} in {fold['seconds']:.2f}s")
 
     # Make error analysis
     # 1. Plot the first 10 test images, and on each image plot the corresponding prediction
@@ -231,21 +602,90 @@ def main_internal(image_folder: str, label_file: str, model_name: str, test_size
     error_analysis(X_test, y_test, y_pred, images_test, model_name, validation_strategy)
 
 
+def run_experiment(model_name: str, validation_strategy: str, params: dict):
+    X, y = shared_data["X"], shared_data["y"]
+    train_index, test_index = shared_data["train_index"], shared_data["test_index"]
+
+    start = time.perf_counter()
+    model = create_model(model_name, **params)
+    # the grid already occupies the pool, so folds run inside this worker
+    accuracy, y_pred, folds = train_and_evaluate(
+        X[train_index], y[train_index], X[test_index], y[test_index], model, validation_strategy, num_workers=1
+    )
+    return accuracy, y_pred, folds, time.perf_counter() - start
+
+
+def run_experiments(
+        image_folder: str,
+        label_file: str,
+        model_names: list,
+        validation_strategies: list,
+        test_size: float = 0.2,
+        num_workers: int = None,
+        results_file: str = "part2/results.csv",
+        search: bool = False
+) -> list:
+    """ Runs every model x validation strategy pair on one loaded and vectorized dataset.
+
+    The feature matrix is put into shared memory once and the grid is trained by a pool of
+    num_workers processes. Error analysis plots are drawn afterwards in this process and
+    test accuracy, mean fold accuracy and training time are written to results_file.
+    With search, every model is tuned once by successive_halving_search before the grid runs.
+    """
+    X, y, images, train_index, test_index = prepare_data(image_folder, label_file, test_size, num_workers)
+
+    model_params = {model_name: {} for model_name in model_names}
+    if search:
+        for model_name in model_names:
+            model_params[model_name], _ = successive_halving_search(
+                model_name, X[train_index], y[train_index], num_workers=num_workers
+            )
+            print(f"Best params for {model_name}: {model_params[model_name]}")
+
+    grid = [(model_name, strategy) for model_name in model_names for strategy in validation_strategies]
+    values = {"y": y, "train_index": train_index, "test_index": test_index}
+    with shared_arrays(X=X) as specs, ProcessPoolExecutor(
+            max_workers=num_workers,
+            initializer=attach_shared_data,
+            initargs=(specs, values)
+    ) as executor:
+        futures = [
+            executor.submit(run_experiment, model_name, strategy, model_params[model_name]) for model_name, strategy in grid
+        ]
+        outcomes = [future.result() for future in futures]
+
+    y_test, images_test = y[test_index], images[test_index]
+    results = []
+    for (model_name, strategy), (accuracy, y_pred, folds, seconds) in zip(grid, outcomes):
+        print(f"Accuracy {strategy} {model_name}: {accuracy:.2f}")
+        error_analysis(X[test_index], y_test, y_pred, images_test, model_name, strategy)
+        cv_accuracy = np.mean([fold["score"] for fold in folds]) if folds else None
+        results.append({
+            "model": model_name, "strategy": strategy, "params": model_params[model_name],
+            "accuracy": accuracy, "cv_accuracy": cv_accuracy, "seconds": seconds
+        })
+
+    with open(results_file, mode='w', newline='') as csvfile:
+        fieldnames = ["model", "strategy", "params", "accuracy", "cv_accuracy", "seconds"]
+        writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter='|')
+        writer.writeheader()
+        writer.writerows(results)
+
+    return results
+
+
 if __name__ == "__main__":
     image_folder = "../dataset/flickr30k_images/"
     label_file = "../dataset/labels.csv"
     test_size = 0.2
 
     models = [logistic_regression, knn, decision_tree]
-    validation_strategy = [simple, kfold, stratified_kfold]
-
-    for model in models:
-        for strategy in validation_strategy:
-            main_internal(
-                image_folder=image_folder,
-                label_file=label_file,
-                model_name=model,
-                test_size=test_size,
-                validation_strategy=strategy
-            )
-            print("-----")
\ No newline at end of file
+    validation_strategy = [simple, kfold, stratified_kfold, leave_one_out]
+
+    run_experiments(
+        image_folder=image_folder,
+        label_file=label_file,
+        model_names=models,
+        validation_strategies=validation_strategy,
+        test_size=test_size
+    )
@@ -3,11 +3,12 @@ import numpy as np
 from sklearn.manifold import TSNE
 from sklearn.cluster import DBSCAN, AgglomerativeClustering
 import pandas as pd
-from sklearn.metrics import silhouette_score
 from sklearn.model_selection import train_test_split
 
-from vectorize import vectorize_images, vectorize_text
-from models import PCA, KMeans
+from vectorize import vectorize_images, vectorize_text, precisions, check_precision
+from models import PCA, KMeans, kmeans_sweep
+from metrics import silhouette_scores
+from search import ExactIndex, IVFIndex, PQIndex
 from visual import visualize_embeddings, visualize_clusters, visualize_nearest_images
 
 def load_data() -> tuple[(np.array, np.array, np.array)]:
@@ -38,25 +39,53 @@ def validation_split(
 
     return X_train, X_test, y_train, y_test
 
-def neighbour_search(text_req: np.ndarray, vImages: np.ndarray, top_k: int = 5) -> np.ndarray:
-    similarities = np.dot(text_req, vImages.T)
-    return np.argsort(-similarities, axis=1)[:, :top_k]
+def build_index(vImages: np.ndarray, exact_limit: int = 100000, compressed: bool = False):
+    ''' exact search for small banks, IVF with ~sqrt(N) cells above exact_limit; save it with index.save.
+        compressed=True keeps only 32-byte product-quantized codes instead of the float vectors. '''
+    if compressed:
+        index = PQIndex(n_subspaces=32)
+    elif len(vImages) <= exact_limit:
+        index = ExactIndex()
+    else:
+        index = IVFIndex(n_lists=int(np.sqrt(len(vImages))), n_probe=16)
+    index.add(vImages)
+    return index
+
+def neighbour_search(text_req: np.ndarray, index, top_k: int = 5) -> np.ndarray:
+    ''' index is an ExactIndex / IVFIndex (see search.load_index) or a raw image matrix '''
+    if isinstance(index, np.ndarray):
+        index = build_index(index)
+    _, top_k_indices = index.search(text_req, top_k=top_k)
+    return top_k_indices
 
 @click.command()
 @click.option('--input_path', type=str, help='Path to the input data')
-@click.option('--n_components', type=int, help='Number of components')
-@click.option('--n_clusters', type=str, help='Number of clusters')
-def main(input_path, n_components, n_clusters):
-    main_internal(n_components, n_clusters)
-
-
-def main_internal(n_components, n_clusters):
+@click.option('--n_components', type=int, default=3, help='Number of components')
+@click.option('--n_clusters', type=int, default=6, help='Number of clusters')
+@click.option('--precision', type=click.Choice(precisions), default="fp32", help='CLIP encoder precision')
+@click.option('--check_precision', 'check', is_flag=True, help='Compare --precision (all reduced ones for fp32) against fp32 and exit')
+def main(input_path, n_components, n_clusters, precision, check):
+    if check:
+        run_precision_check(precision)
+    else:
+        main_internal(n_components, n_clusters, precision)
+
+
+def run_precision_check(precision, sample_size=64):
+    ''' prints how close reduced precision embeddings of the first sample_size images and captions are to fp32 '''
+    _, descriptions, images = load_data()
+    for checked in ([precision] if precision != "fp32" else precisions[1:]):
+        result = check_precision(images[:sample_size], descriptions[:sample_size], precision=checked)
+        print(f"{checked} vs fp32: " + ", ".join(f"{name} {value:.4f}" for name, value in result.items()))
+
+
+def main_internal(n_components, n_clusters, precision="fp32"):
     # load image data and text labels
     labels, descriptions, images = load_data()
     print(f"Loaded {len(images)} images and {len(descriptions)} descriptions")
 
     # vectorize images and text labels
-    vImages = vectorize_images(images)
+    vImages = vectorize_images(images, precision=precision)
     print(f"Vectorized images to shape {vImages.shape}")
 
      # PCA or t-SNE on images
@@ -66,11 +95,10 @@ def main_internal(n_components, n_clusters):
     tsne_3d_embeddings = tsne_3d.fit_transform(vImages)
     print(f"t-SNE embeddings shapes: {tsne_2d_embeddings.shape}, {tsne_3d_embeddings.shape}")
 
-    pca_2d = PCA(n_components=2)
-    pca_2d.fit(vImages)
-    pca_2d_embeddings = pca_2d.transform(vImages)
+    # components are sorted, so the 2D projection is the first two of the single 3D fit
     pca_3d = PCA(n_components=3)
     pca_3d.fit(vImages)
+    pca_2d_embeddings = pca_3d.transform(vImages, n_components=2)
     pca_3d_embeddings = pca_3d.transform(vImages)
     print(f"PCA embeddings shapes: {pca_2d_embeddings.shape}, {pca_3d_embeddings.shape}")
 
@@ -79,26 +107,23 @@ def main_internal(n_components, n_clusters):
     visualize_embeddings(tsne_3d_embeddings, pca_3d_embeddings, labels, name_file="3d")
 
     # Perform clustering on the embeddings and visualize the results
-    kmeans_org = KMeans(n_clusters=n_clusters, max_iterations=100)
+    kmeans_org = KMeans(n_clusters=n_clusters, max_iterations=100, n_init=8, algorithm='hamerly')
     kmeans_org.fit(vImages)
     cluster_labels_org = kmeans_org.predict(vImages)
 
-    kmeans_pca = KMeans(n_clusters=n_clusters, max_iterations=100)
+    kmeans_pca = KMeans(n_clusters=n_clusters, max_iterations=100, n_init=8, num_workers=1)
     kmeans_pca.fit(pca_3d_embeddings)
     cluster_labels_pca = kmeans_pca.predict(pca_3d_embeddings)
 
     # Visualize 3D embeddings of images and color points based on cluster label and original labels
     visualize_clusters(vImages[:, :3], cluster_labels_org, pca_3d_embeddings, cluster_labels_pca, labels, name_file="KMeans")
 
-    silhouette_scores = []
+    # pairwise distances are computed once for all k
     cluster_range = range(2, 10)
-    for k in cluster_range:
-        kmeans = KMeans(n_clusters=k, max_iterations=100)
-        kmeans.fit(pca_3d_embeddings)
-        labels_k = kmeans.predict(pca_3d_embeddings)
-        score = silhouette_score(pca_3d_embeddings, labels_k)
-        silhouette_scores.append(score)
-        print(f"Silhouette score for k={k}: {score}")
+    kmeans_models = kmeans_sweep(pca_3d_embeddings, cluster_range, max_iterations=100, n_init=8, num_workers=1)
+    labelings = [kmeans.predict(pca_3d_embeddings) for kmeans in kmeans_models]
+    for k, result in zip(cluster_range, silhouette_scores(pca_3d_embeddings, labelings)):
+        print(f"Silhouette score for k={k}: {result['score']}")
     
     agglo = AgglomerativeClustering(n_clusters=n_clusters)
     cluster_labels_hierarchical = agglo.fit_predict(pca_3d_embeddings)
@@ -115,17 +140,17 @@ def main_internal(n_components, n_clusters):
     non_outlier_indices = np.where(dbscan_labels != -1)[0]
     X_train_clean = X_train[non_outlier_indices]
 
-    kmeans_clean = KMeans(n_clusters=n_clusters, max_iterations=100)
+    kmeans_clean = KMeans(n_clusters=n_clusters, max_iterations=100, n_init=8, num_workers=1)
     kmeans_clean.fit(X_train_clean)
     kmeans_clean.predict(X_train_clean)
     print(f"Number of samples before cleaning: {X_train.shape[0]}, after cleaning: {X_train_clean.shape[0]}")
 
     # Select few text descriptions and select nearest neighbors based on embeddings. 
-    vTexts = vectorize_text(descriptions)
+    vTexts = vectorize_text(descriptions, precision=precision)
     pca_3d.transform(vTexts)
     
     # Plot the results: text description, few nearest images
-    top_k_indices = neighbour_search(vTexts, vImages, top_k=5)
+    top_k_indices = neighbour_search(vTexts, build_index(vImages), top_k=5)
     for i, text in enumerate(descriptions):
         print(f"Text query: {text}")
         indices = top_k_indices[i]
@@ -138,4 +163,4 @@ def main_internal(n_components, n_clusters):
     visualize_nearest_images(descriptions, top_k_indices, images)
 
 if __name__ == "__main__":
-    main_internal(n_components=3, n_clusters=6)
\ No newline at end of file
+    main()
\ No newline at end of file
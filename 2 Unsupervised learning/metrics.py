@@ -0,0 +1,76 @@
+import numpy as np
+from scipy.stats import norm
+
+
+def distance_blocks(X: np.ndarray, rows: np.ndarray, block_size: int = 1024):
+    ''' yields (row indices, euclidean distances from those rows to every sample) block by block '''
+    squared_norms = np.einsum('ij,ij->i', X, X)
+    for start in range(0, len(rows), block_size):
+        block_rows = rows[start:start + block_size]
+        distances = X[block_rows] @ X.T
+        distances *= -2
+        distances += squared_norms[block_rows, np.newaxis]
+        distances += squared_norms
+        np.sqrt(np.maximum(distances, 0, out=distances), out=distances)
+        # the GEMM leaves rounding noise where the exact self distance is zero
+        distances[np.arange(len(block_rows)), block_rows] = 0
+        yield block_rows, distances
+
+
+def silhouette_scores(X: np.ndarray, labelings: list, sample_size: int = None, confidence: float = 0.95,
+                      block_size: int = 1024, random_state: int = 42) -> list:
+    ''' Silhouette score of every labeling in labelings (e.g. one per candidate k) over the same X.
+
+        Pairwise distances are computed once, block by block, and every block is reused for all
+        labelings: per-cluster distance sums are one matmul of the block with the labeling's
+        one-hot matrix. Memory is block_size x n_samples, never n_samples².
+
+        With sample_size only that many random samples get their silhouette computed (against all
+        samples), which costs sample_size x n_samples, and the result carries a normal-approximation
+        confidence interval. Returns a dict per labeling with score, ci_low and ci_high. '''
+    X = np.asarray(X, dtype=np.float64)
+    n_samples = X.shape[0]
+
+    one_hots, cluster_indices, cluster_sizes = [], [], []
+    for labels in labelings:
+        _, index = np.unique(labels, return_inverse=True)
+        one_hot = np.zeros((n_samples, index.max() + 1))
+        one_hot[np.arange(n_samples), index] = 1
+        one_hots.append(one_hot)
+        cluster_indices.append(index)
+        cluster_sizes.append(one_hot.sum(axis=0))
+
+    if sample_size is None or sample_size >= n_samples:
+        rows = np.arange(n_samples)
+    else:
+        rows = np.sort(np.random.default_rng(random_state).choice(n_samples, size=sample_size, replace=False))
+
+    silhouettes = np.zeros((len(labelings), len(rows)))
+    position = 0
+    for block_rows, distances in distance_blocks(X, rows, block_size):
+        block = slice(position, position + len(block_rows))
+        position += len(block_rows)
+
+        for i, (one_hot, index, sizes) in enumerate(zip(one_hots, cluster_indices, cluster_sizes)):
+            sums = distances @ one_hot
+            own = index[block_rows]
+            own_sizes = sizes[own]
+            local = np.arange(len(block_rows))
+
+            a = sums[local, own] / np.maximum(own_sizes - 1, 1)
+            means = sums / sizes
+            means[local, own] = np.inf
+            b = means.min(axis=1)
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                s = (b - a) / np.maximum(a, b)
+            # like sklearn: samples alone in their cluster score 0
+            silhouettes[i, block] = np.where(own_sizes > 1, np.nan_to_num(s), 0)
+
+    z = norm.ppf(0.5 + confidence / 2)
+    results = []
+    for values in silhouettes:
+        score = float(values.mean())
+        margin = 0.0 if len(rows) == n_samples else float(z * values.std(ddof=1) / np.sqrt(len(values)))
+        results.append({"score": score, "ci_low": score - margin, "ci_high": score + margin})
+    return results
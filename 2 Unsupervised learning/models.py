@@ -1,16 +1,49 @@
+import copy
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
+from scipy import sparse
+
+# data shared with pool workers, attached once per worker process
+shared_data = {}
+# below this many values in X, starting worker processes and sending X costs more than the fits
+min_parallel_size = 1_000_000
 
 class PCA:
-    def __init__(self, n_components: int):
+    def __init__(self, n_components: int, solver: str = 'auto', n_oversamples: int = 10, n_iter: int = 4, random_state: int = 42):
+        """ solver: 'full' eigendecomposes the whole covariance matrix, 'randomized' finds only the
+            leading n_components with a randomized range finder, 'auto' picks randomized when
+            n_components is small compared to the data """
         self.n_components = n_components
+        self.solver = solver
+        self.n_oversamples = n_oversamples
+        self.n_iter = n_iter
+        self.random_state = random_state
         self.components = None
         self.mean = None
         self.std = None
 
     def fit(self, X: np.ndarray) -> None:
         # standardize data
+        self.mean = None
         X_std = self.standardize(X)
 
+        solver = self.solver
+        if solver == 'auto':
+            # below ~1000 features the covariance route is as fast as the range finder
+            solver = 'randomized' if min(X.shape) > 1000 and self.n_components < 0.1 * min(X.shape) else 'full'
+
+        if solver == 'full':
+            self.fit_full(X_std)
+        elif solver == 'randomized':
+            self.fit_randomized(X_std)
+        else:
+            raise NotImplementedError
+
+        # reduce data using number of components (n_components)
+        self.components = self.eigenvectors[:, :self.n_components]
+
+    def fit_full(self, X_std: np.ndarray) -> None:
         # calculate covariance matrix
         covariance_matrix = np.cov(X_std.T)
 
@@ -22,11 +55,26 @@ class PCA:
         self.eigenvalues = eigenvalues[idx]
         self.eigenvectors = eigenvectors[:, idx]
 
-        # reduce data using number of components (n_components)
-        self.components = self.eigenvectors[:, :self.n_components]
+    def fit_randomized(self, X_std: np.ndarray) -> None:
+        ''' truncated SVD of the standardized data through a randomized range finder (Halko et al.) '''
+        rng = np.random.default_rng(self.random_state)
+        n_random = min(self.n_components + self.n_oversamples, min(X_std.shape))
+
+        # power iterations, re-orthonormalized so small singular values do not vanish
+        Q = X_std @ rng.standard_normal((X_std.shape[1], n_random))
+        for _ in range(self.n_iter):
+            Q, _ = np.linalg.qr(Q)
+            Q, _ = np.linalg.qr(X_std.T @ Q)
+            Q = X_std @ Q
+        Q, _ = np.linalg.qr(Q)
 
-    def transform(self, X: np.ndarray) -> np.ndarray:
-        return np.dot(self.standardize(X) , self.components)
+        _, singular_values, Vt = np.linalg.svd(Q.T @ X_std, full_matrices=False)
+        self.eigenvalues = singular_values[:self.n_components] ** 2 / (X_std.shape[0] - 1)
+        self.eigenvectors = Vt[:self.n_components].T
+
+    def transform(self, X: np.ndarray, n_components: int = None) -> np.ndarray:
+        ''' n_components below the fitted number projects on the leading ones only '''
+        return np.dot(self.standardize(X), self.components[:, :n_components])
 
     def standardize(self, X: np.ndarray) -> np.ndarray:
         if self.mean is None:
@@ -36,21 +84,128 @@ class PCA:
         X_norm = (X - self.mean) / (self.std + 1e-8)
         return X_norm
 
+class IncrementalPCA:
+    def __init__(self, n_components: int, batch_size: int = 1024):
+        """ PCA that sees the data batch by batch, memory grows with the batch and not the dataset.
+
+            Keeps a running mean and variance (Chan et al.) and a rank n_components factor
+            S @ Vt of the standardized data seen so far (Ross et al., as sklearn's IncrementalPCA);
+            every batch is stacked under the factor and the stack is re-decomposed. Standardization
+            matches PCA, so the factor is rescaled whenever the running std changes. """
+        self.n_components = n_components
+        self.batch_size = batch_size
+        self.components = None
+        self.singular_values = None
+        self.mean = None
+        self.var = None
+        self.std = None
+        self.n_samples = 0
+
+    def partial_fit(self, X: np.ndarray) -> None:
+        X = np.asarray(X, dtype=np.float64)
+        n_batch = X.shape[0]
+        if self.n_samples == 0 and n_batch < self.n_components:
+            raise ValueError(f"First batch has {n_batch} samples, needs at least n_components={self.n_components}")
+
+        batch_mean = np.mean(X, axis=0)
+        batch_m2 = np.sum((X - batch_mean) ** 2, axis=0)
+
+        if self.n_samples == 0:
+            n_total = n_batch
+            mean, m2 = batch_mean, batch_m2
+        else:
+            n_total = self.n_samples + n_batch
+            delta = batch_mean - self.mean
+            mean = self.mean + delta * n_batch / n_total
+            m2 = self.var * self.n_samples + batch_m2 + delta ** 2 * self.n_samples * n_batch / n_total
+
+        std = np.sqrt(m2 / n_total) + 1e-8
+        stacked = (X - batch_mean) / std
+
+        if self.n_samples > 0:
+            # previous factor rescaled to the new std, plus the row correcting for the mean shift
+            previous = self.singular_values[:, np.newaxis] * self.components.T * (self.std / std)
+            mean_correction = np.sqrt(self.n_samples * n_batch / n_total) * (self.mean - batch_mean) / std
+            stacked = np.vstack([previous, stacked, mean_correction])
+
+        _, singular_values, Vt = np.linalg.svd(stacked, full_matrices=False)
+
+        self.singular_values = singular_values[:self.n_components]
+        self.components = Vt[:self.n_components].T
+        self.eigenvalues = self.singular_values ** 2 / max(n_total - 1, 1)
+        self.mean, self.var, self.std = mean, m2 / n_total, std
+        self.n_samples = n_total
+
+    def fit(self, X: np.ndarray) -> None:
+        ''' X may be a memory-mapped array, only batch_size rows are read at a time '''
+        self.n_samples = 0
+        for start in range(0, X.shape[0], self.batch_size):
+            self.partial_fit(X[start:start + self.batch_size])
+
+    def fit_batches(self, batches) -> None:
+        ''' fits from any iterable of batches, e.g. vectorize_image_batches '''
+        self.n_samples = 0
+        for batch in batches:
+            self.partial_fit(batch)
+
+    def transform(self, X: np.ndarray, n_components: int = None) -> np.ndarray:
+        return np.dot((np.asarray(X) - self.mean) / self.std, self.components[:, :n_components])
+
 class KMeans:
-    def __init__(self, n_clusters: int, max_iterations: int):
+    def __init__(self, n_clusters: int, max_iterations: int, init='k-means++', dtype=np.float64, random_state: int = 42,
+                 algorithm: str = 'lloyd', n_init: int = 1, num_workers: int = None):
+        """ init: 'k-means++' spreads the initial centroids by sampling proportional to squared distance,
+            'random' picks random samples, an array gives the initial centroids;
+            dtype=np.float32 halves memory and speeds up the distance GEMM;
+            algorithm: 'lloyd' recomputes every distance each iteration, 'hamerly' skips points whose
+            assignment provably cannot change (same result, far fewer distances once clusters settle);
+            n_init: number of differently seeded runs, the one with the lowest inertia is kept,
+            they run in a pool of num_workers processes (1 runs them here, as does a small X) """
         self.n_clusters = n_clusters
         self.max_iter = max_iterations
+        self.init = init
+        self.algorithm = algorithm
+        self.dtype = dtype
+        self.random_state = random_state
+        self.n_init = n_init
+        self.num_workers = num_workers
 
         # randomly initialize cluster centroids
         self.centroids = None
+        self.inertia = None
+        self.n_iter = 0
 
     def fit(self, X: np.ndarray) -> None:
-        np.random.seed(42)
+        X = np.asarray(X, dtype=self.dtype)
+        if self.n_init > 1 and not isinstance(self.init, np.ndarray):
+            return self.fit_restarts(X)
+
+        self.rng = np.random.default_rng(self.random_state)
+        self.centroids = self.init_centroids(X)
+
+        if self.algorithm == 'hamerly' and self.n_clusters > 1:
+            self.fit_hamerly(X)
+        elif self.algorithm in ['lloyd', 'hamerly']:
+            self.fit_lloyd(X)
+        else:
+            raise NotImplementedError
+
+        self.inertia = float(np.sum(np.min(self.compute_squared_distances(X, self.centroids), axis=1)))
+
+    def fit_restarts(self, X: np.ndarray) -> None:
+        seeds = np.random.default_rng(self.random_state).integers(2 ** 31, size=self.n_init)
+        restarts = []
+        for seed in seeds:
+            restart = copy.copy(self)
+            restart.n_init, restart.random_state = 1, int(seed)
+            restarts.append(restart)
 
-        random_indices = np.random.permutation(X.shape[0])[:self.n_clusters]
-        self.centroids = X[random_indices]
+        best = min(fit_in_pool(restarts, X, self.num_workers), key=lambda model: model.inertia)
+        self.centroids, self.inertia, self.n_iter = best.centroids, best.inertia, best.n_iter
+        self.rng = best.rng
 
-        for _ in range(self.max_iter):
+    def fit_lloyd(self, X: np.ndarray) -> None:
+        for self.n_iter in range(1, self.max_iter + 1):
             # create clusters by assigning the samples to the nearest centroids
             clusters = self.assign_clusters(self.centroids, X)
             # update centroids
@@ -61,37 +216,280 @@ class KMeans:
 
             self.centroids = new_centroids
 
+    def fit_hamerly(self, X: np.ndarray) -> None:
+        ''' Hamerly's algorithm: every point keeps an upper bound on the distance to its centroid and a
+            lower bound on the distance to any other one. A point cannot change cluster while its upper
+            bound is below max(lower bound, half the distance from its centroid to the nearest other one),
+            so only the remaining points get their distances recomputed. The usual upper bound
+            tightening is left out, per-row norms are not cheaper than the GEMM in numpy. '''
+        squared_norms = np.einsum('ij,ij->i', X, X)
+
+        clusters, upper, lower = self.nearest_two(X, self.centroids, squared_norms)
+
+        for self.n_iter in range(1, self.max_iter + 1):
+            new_centroids = self.compute_means(clusters, X)
+            converged = np.allclose(self.centroids, new_centroids)
+            shift = np.linalg.norm(new_centroids - self.centroids, axis=1)
+            self.centroids = new_centroids
+            if converged:
+                break
+
+            # moving centroids loosen the bounds by at most their own shift
+            upper += shift[clusters]
+            largest = np.argsort(shift)[::-1][:2]
+            lower -= np.where(clusters == largest[0], shift[largest[1]], shift[largest[0]])
+
+            center_distances = self.compute_distances(self.centroids, self.centroids)
+            np.fill_diagonal(center_distances, np.inf)
+            bound = np.maximum(0.5 * np.min(center_distances, axis=1)[clusters], lower)
+
+            candidates = np.flatnonzero(upper > bound)
+            if candidates.size == 0:
+                continue
+
+            # gathering rows costs about as much as the GEMM itself, so only do it for a minority
+            if candidates.size > X.shape[0] // 2:
+                clusters, upper, lower = self.nearest_two(X, self.centroids, squared_norms)
+            else:
+                clusters[candidates], upper[candidates], lower[candidates] = self.nearest_two(
+                    X[candidates], self.centroids, squared_norms[candidates]
+                )
+
+    def nearest_two(self, X: np.ndarray, centroids: np.ndarray, squared_norms: np.ndarray) -> tuple:
+        ''' nearest centroid, distance to it and distance to the second nearest '''
+        distances = self.compute_squared_distances(X, centroids, squared_norms)
+        rows = np.arange(X.shape[0])
+        clusters = np.argmin(distances, axis=1)
+        nearest = np.sqrt(distances[rows, clusters])
+        distances[rows, clusters] = np.inf
+        return clusters, nearest, np.sqrt(np.min(distances, axis=1))
+
+    def init_centroids(self, X: np.ndarray) -> np.ndarray:
+        if isinstance(self.init, np.ndarray):
+            return np.array(self.init, dtype=X.dtype)
+        elif self.init == 'random':
+            random_indices = self.rng.permutation(X.shape[0])[:self.n_clusters]
+            return X[random_indices].copy()
+        elif self.init == 'k-means++':
+            return self.kmeans_plus_plus(X)
+        else:
+            raise NotImplementedError
+
+    def kmeans_plus_plus(self, X: np.ndarray, initial: np.ndarray = None) -> np.ndarray:
+        ''' greedy k-means++: of a few candidates sampled by squared distance keep the one lowering the potential most;
+            with initial centroids only the remaining ones are seeded '''
+        n_trials = 2 + int(np.log(self.n_clusters))
+        squared_norms = np.einsum('ij,ij->i', X, X)
+
+        centroids = np.empty((self.n_clusters, X.shape[1]), dtype=X.dtype)
+        if initial is None:
+            centroids[0] = X[self.rng.integers(X.shape[0])]
+            n_initial = 1
+        else:
+            n_initial = len(initial)
+            centroids[:n_initial] = initial
+        closest = np.min(self.compute_squared_distances(X, centroids[:n_initial], squared_norms), axis=1)
+
+        for c in range(n_initial, self.n_clusters):
+            total = closest.sum()
+            if total > 0:
+                candidates = self.rng.choice(X.shape[0], size=n_trials, p=closest / total)
+            else:
+                candidates = self.rng.integers(X.shape[0], size=n_trials)
+
+            candidate_distances = np.minimum(closest[:, np.newaxis], self.compute_squared_distances(X, X[candidates], squared_norms))
+            best = np.argmin(candidate_distances.sum(axis=0))
+            centroids[c] = X[candidates[best]]
+            closest = candidate_distances[:, best]
+
+        return centroids
+
     def predict(self, X: np.ndarray) -> np.ndarray:
         # for each sample search for nearest centroids
-        distances = self.compute_distances(X, self.centroids)
+        distances = self.compute_squared_distances(np.asarray(X, dtype=self.dtype), self.centroids)
         return np.argmin(distances, axis=1)
 
     def assign_clusters(self, centroids: np.ndarray, X: np.ndarray) -> np.ndarray:
         ''' given input data X and cluster centroids assign clusters to samples '''
-        distances = self.compute_distances(X, centroids)
+        distances = self.compute_squared_distances(X, centroids)
         cluster_indices = np.argmin(distances, axis=1)
         return cluster_indices
 
     def compute_means(self, clusters: np.ndarray, X: np.ndarray) -> np.ndarray:
         ''' recompute cluster centroids'''
-        centroids = np.zeros((self.n_clusters, X.shape[1]))
-        for i in range(self.n_clusters):
-            cluster_points = X[clusters == i]
-            if len(cluster_points) == 0:
-                if X.shape[0] > 0:
-                    centroids[i] = X[np.random.randint(0, X.shape[0])]
-                else:
-                    centroids[i] = np.zeros(X.shape[1])
-            else:
-                centroids[i] = np.mean(cluster_points, axis=0)
-        return centroids
-    
+        counts = np.bincount(clusters, minlength=self.n_clusters)
+        # sparse cluster indicator matrix times X, several times faster than np.add.at
+        indicator = sparse.csr_matrix(
+            (np.ones(X.shape[0], dtype=X.dtype), (clusters, np.arange(X.shape[0]))),
+            shape=(self.n_clusters, X.shape[0])
+        )
+        sums = indicator @ X
+
+        centroids = sums / np.maximum(counts, 1)[:, np.newaxis]
+        empty = np.flatnonzero(counts == 0)
+        if len(empty) > 0 and X.shape[0] > 0:
+            centroids[empty] = X[self.rng.integers(0, X.shape[0], size=len(empty))]
+        return centroids.astype(X.dtype, copy=False)
+
+    def compute_squared_distances(self, X: np.ndarray, centroids: np.ndarray, squared_norms: np.ndarray = None) -> np.ndarray:
+        ''' all squared distances with one GEMM: ‖x‖² - 2 x·c + ‖c‖² '''
+        if squared_norms is None:
+            squared_norms = np.einsum('ij,ij->i', X, X)
+        distances = X @ centroids.T
+        distances *= -2
+        distances += squared_norms[:, np.newaxis]
+        distances += np.einsum('ij,ij->i', centroids, centroids)
+        return np.maximum(distances, 0, out=distances)
+
     def compute_distances(self, X: np.ndarray, centroids: np.ndarray) -> np.ndarray:
-        distances = np.zeros((X.shape[0], self.n_clusters))
-        for idx, centroid in enumerate(centroids):
-            distances[:, idx] = np.linalg.norm(X - centroid, axis=1)
-        return distances
+        return np.sqrt(self.compute_squared_distances(X, centroids))
 
     def euclidean_distance(self, a, b) -> float:
         """ Calculates the euclidean distance between two vectors a and b """
-        return np.sqrt(np.sum(np.power(a - b, 2)))
\ No newline at end of file
+        return np.sqrt(np.sum(np.power(a - b, 2)))
+
+def attach_data(X: np.ndarray) -> None:
+    shared_data["X"] = X
+
+
+def fit_shared(model):
+    model.fit(shared_data["X"])
+    return model
+
+
+def fit_in_pool(models: list, X: np.ndarray, num_workers: int = None) -> list:
+    ''' fits models on X in a pool of num_workers processes, X is sent once per worker;
+        serially when num_workers is 1 or X is smaller than min_parallel_size '''
+    if num_workers == 1 or len(models) == 1 or np.size(X) < min_parallel_size:
+        for model in models:
+            model.fit(X)
+        return models
+
+    for model in models:
+        # the pool is already busy, restarts of every model run inside its worker
+        model.num_workers = 1
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=attach_data, initargs=(X,)) as executor:
+        return list(executor.map(fit_shared, models))
+
+
+def kmeans_sweep(X: np.ndarray, cluster_range, max_iterations: int = 100, warm_start: bool = False,
+                 num_workers: int = None, **kwargs) -> list:
+    ''' Fits KMeans for every k in cluster_range, returns the models in the same order.
+
+        Without warm_start all k run in parallel. With warm_start the ks run in increasing order and
+        k+1 starts from k's centroids plus one k-means++ seeded centroid, which usually converges
+        in a few iterations. kwargs go to KMeans (e.g. n_init, algorithm). '''
+    cluster_range = list(cluster_range)
+    if not warm_start:
+        models = [KMeans(n_clusters=k, max_iterations=max_iterations, **kwargs) for k in cluster_range]
+        return fit_in_pool(models, X, num_workers)
+
+    X = np.asarray(X, dtype=kwargs.get('dtype', np.float64))
+    models = []
+    previous = None
+    for k in cluster_range:
+        model = KMeans(n_clusters=k, max_iterations=max_iterations, num_workers=num_workers, **kwargs)
+        if previous is not None and previous.n_clusters < k:
+            model.rng = np.random.default_rng(model.random_state)
+            model.init = model.kmeans_plus_plus(X, initial=previous.centroids)
+        model.fit(X)
+        models.append(model)
+        previous = model
+    return models
+
+
+class MiniBatchKMeans(KMeans):
+    def __init__(self, n_clusters: int, max_iterations: int = 100, batch_size: int = 1024, tol: float = 1e-4,
+                 max_no_improvement: int = 10, init: str = 'k-means++', dtype=np.float64, random_state: int = 42):
+        """ KMeans updated from random batches, every centroid moves with its own learning rate
+            1 / (number of samples it has absorbed so far), as in Sculley's web-scale k-means.
+            max_iterations counts batches; fitting stops early once centroids move less than tol
+            (relative to the data variance) or the smoothed batch inertia has not improved for
+            max_no_improvement batches. X may be a memory-mapped array. """
+        super().__init__(n_clusters, max_iterations, init=init, dtype=dtype, random_state=random_state)
+        self.batch_size = batch_size
+        self.tol = tol
+        self.max_no_improvement = max_no_improvement
+        self.counts = None
+
+    def init_from_sample(self, sample: np.ndarray) -> None:
+        self.centroids = self.init_centroids(sample)
+        self.counts = np.zeros(self.n_clusters)
+        self.tol_scaled = self.tol * np.mean(np.var(sample, axis=0))
+        self.ewa_inertia = None
+        self.best_inertia = np.inf
+        self.no_improvement = 0
+
+    def partial_fit(self, X: np.ndarray) -> None:
+        X = np.asarray(X, dtype=self.dtype)
+        if self.centroids is None:
+            self.rng = np.random.default_rng(self.random_state)
+            self.init_from_sample(X)
+        self.step(X)
+
+    def step(self, X: np.ndarray) -> bool:
+        ''' one mini-batch update, returns True when fitting should stop '''
+        distances = self.compute_squared_distances(X, self.centroids)
+        clusters = np.argmin(distances, axis=1)
+        batch_inertia = np.mean(distances[np.arange(X.shape[0]), clusters])
+
+        batch_counts = np.bincount(clusters, minlength=self.n_clusters)
+        indicator = sparse.csr_matrix(
+            (np.ones(X.shape[0], dtype=X.dtype), (clusters, np.arange(X.shape[0]))),
+            shape=(self.n_clusters, X.shape[0])
+        )
+        batch_sums = indicator @ X
+
+        # c <- c + (sum of new points - n_new * c) / n_total, i.e. a per-centroid learning rate
+        self.counts += batch_counts
+        updated = batch_counts > 0
+        new_centroids = self.centroids.copy()
+        new_centroids[updated] += (
+            batch_sums[updated] - batch_counts[updated, np.newaxis] * self.centroids[updated]
+        ) / self.counts[updated, np.newaxis]
+
+        movement = np.sum((new_centroids - self.centroids) ** 2) / self.n_clusters
+        self.centroids = new_centroids.astype(self.dtype, copy=False)
+
+        alpha = min(1.0, 2 * X.shape[0] / (self.batch_size + 1))
+        self.ewa_inertia = batch_inertia if self.ewa_inertia is None else (1 - alpha) * self.ewa_inertia + alpha * batch_inertia
+        if self.ewa_inertia < self.best_inertia:
+            self.best_inertia = self.ewa_inertia
+            self.no_improvement = 0
+        else:
+            self.no_improvement += 1
+
+        return movement <= self.tol_scaled or self.no_improvement >= self.max_no_improvement
+
+    def fit(self, X: np.ndarray) -> None:
+        self.rng = np.random.default_rng(self.random_state)
+        n_samples = X.shape[0]
+
+        # sorted row indices keep reads of a memory-mapped X sequential
+        init_size = min(n_samples, max(3 * self.batch_size, 3 * self.n_clusters))
+        sample = np.sort(self.rng.choice(n_samples, size=init_size, replace=False))
+        self.init_from_sample(np.asarray(X[sample], dtype=self.dtype))
+
+        for self.n_iter in range(1, self.max_iter + 1):
+            batch = np.sort(self.rng.integers(0, n_samples, size=min(self.batch_size, n_samples)))
+            if self.step(np.asarray(X[batch], dtype=self.dtype)):
+                break
+
+        # estimate from the smoothed batch inertia, a full pass over X would defeat the purpose
+        self.inertia = float(self.ewa_inertia * n_samples)
+
+    def fit_batches(self, batches) -> None:
+        ''' single pass over an iterable of batches, e.g. chunks of an embedding file '''
+        self.rng = np.random.default_rng(self.random_state)
+        self.centroids = None
+        n_samples = 0
+        for self.n_iter, batch in enumerate(batches, start=1):
+            batch = np.asarray(batch, dtype=self.dtype)
+            n_samples += batch.shape[0]
+            if self.centroids is None:
+                self.init_from_sample(batch)
+            if self.step(batch) or self.n_iter >= self.max_iter:
+                break
+
+        # estimated over the samples consumed before stopping
+        self.inertia = float(self.ewa_inertia * n_samples)
@@ -0,0 +1,274 @@
+import numpy as np
+
+from models import KMeans
+
+
+def top_k_merge(scores: np.ndarray, ids: np.ndarray, top_k: int) -> tuple:
+    ''' keeps the top_k highest scores of every row, sorted, without a full sort '''
+    if scores.shape[1] > top_k:
+        keep = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        scores = np.take_along_axis(scores, keep, axis=1)
+        ids = np.take_along_axis(ids, keep, axis=1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+class ExactIndex:
+    def __init__(self, block_size: int = 8192):
+        """ Brute force inner product search (cosine for normalized CLIP vectors).
+            The bank is scored block_size vectors at a time and only the running top k is kept,
+            so memory is queries x (block_size + k) instead of queries x bank. """
+        self.block_size = block_size
+        self.vectors = None
+
+    def add(self, vectors: np.ndarray) -> None:
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.vectors = vectors if self.vectors is None else np.vstack([self.vectors, vectors])
+
+    def search(self, queries: np.ndarray, top_k: int = 5) -> tuple:
+        ''' returns (scores, ids) of shape (n_queries, top_k), best first '''
+        queries = np.asarray(queries, dtype=np.float32)
+        top_k = min(top_k, len(self.vectors))
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, len(self.vectors), self.block_size):
+            scores = queries @ self.vectors[start:start + self.block_size].T
+            ids = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+            best_scores, best_ids = top_k_merge(
+                np.hstack([best_scores, scores]), np.hstack([best_ids, ids]), top_k
+            )
+        return best_scores, best_ids
+
+    def save(self, path: str) -> None:
+        np.savez(path, kind="exact", vectors=self.vectors, block_size=self.block_size)
+
+
+class IVFIndex:
+    def __init__(self, n_lists: int = 64, n_probe: int = 8, max_iterations: int = 25,
+                 train_size: int = 64, random_state: int = 42):
+        """ Inverted file index: the project's KMeans splits the bank into n_lists cells and a query
+            only scores the vectors of its n_probe nearest cells. Vectors are stored grouped by cell,
+            so every probed cell is one contiguous matmul. The quantizer is trained on at most
+            train_size x n_lists random vectors, which is plenty to place the cells. """
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.max_iterations = max_iterations
+        self.train_size = train_size
+        self.random_state = random_state
+        self.quantizer = None
+        self.vectors = None
+        self.ids = None
+        self.offsets = None
+
+    def train(self, vectors: np.ndarray) -> None:
+        sample_size = self.train_size * self.n_lists
+        if len(vectors) > sample_size:
+            rows = np.random.default_rng(self.random_state).choice(len(vectors), size=sample_size, replace=False)
+            vectors = vectors[np.sort(rows)]
+        self.quantizer = KMeans(n_clusters=self.n_lists, max_iterations=self.max_iterations, dtype=np.float32,
+                                random_state=self.random_state)
+        self.quantizer.fit(vectors)
+
+    def add(self, vectors: np.ndarray) -> None:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.quantizer is None:
+            self.train(vectors)
+
+        start_id = 0 if self.ids is None else len(self.ids)
+        ids = np.arange(start_id, start_id + len(vectors))
+        lists = self.quantizer.predict(vectors)
+        if self.vectors is not None:
+            # re-group old and new vectors together, lists of the old ones are recovered from offsets
+            old_lists = np.repeat(np.arange(self.n_lists), np.diff(self.offsets))
+            vectors = np.vstack([self.vectors, vectors])
+            ids = np.concatenate([self.ids, ids])
+            lists = np.concatenate([old_lists, lists])
+
+        order = np.argsort(lists, kind='stable')
+        self.vectors = np.ascontiguousarray(vectors[order])
+        self.ids = ids[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=self.n_lists))])
+
+    def search(self, queries: np.ndarray, top_k: int = 5) -> tuple:
+        ''' returns (scores, ids) of shape (n_queries, top_k), best first; missing results have id -1 '''
+        queries = np.asarray(queries, dtype=np.float32)
+        n_probe = min(self.n_probe, self.n_lists)
+        cell_distances = self.quantizer.compute_squared_distances(queries, self.quantizer.centroids)
+        probes = np.argpartition(cell_distances, n_probe - 1, axis=1)[:, :n_probe]
+
+        best_scores = np.full((len(queries), top_k), -np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), top_k), -1, dtype=np.int64)
+
+        # score cell by cell, each against all queries probing it
+        for cell in np.unique(probes):
+            start, end = self.offsets[cell], self.offsets[cell + 1]
+            if start == end:
+                continue
+            rows = np.flatnonzero((probes == cell).any(axis=1))
+            scores = queries[rows] @ self.vectors[start:end].T
+            ids = np.broadcast_to(self.ids[start:end], scores.shape)
+            best_scores[rows], best_ids[rows] = top_k_merge(
+                np.hstack([best_scores[rows], scores]), np.hstack([best_ids[rows], ids]), top_k
+            )
+        return best_scores, best_ids
+
+    def save(self, path: str) -> None:
+        np.savez(
+            path, kind="ivf", vectors=self.vectors, ids=self.ids, offsets=self.offsets,
+            centroids=self.quantizer.centroids, n_probe=self.n_probe
+        )
+
+
+class ProductQuantizer:
+    def __init__(self, n_subspaces: int = 32, max_iterations: int = 25, train_size: int = 64, random_state: int = 42):
+        """ Product quantization codec: each vector is split into n_subspaces chunks and every chunk is
+            replaced by the index of its nearest of 256 centroids (the project's KMeans per chunk), so a
+            512-dim float32 vector (2 KB) becomes n_subspaces bytes.
+
+            Distances to codes are asymmetric: the query stays exact and per-chunk lookup tables of
+            query-to-centroid values are summed over the codes, no decoding needed. """
+        self.n_subspaces = n_subspaces
+        self.max_iterations = max_iterations
+        self.train_size = train_size
+        self.random_state = random_state
+        self.codebooks = None
+
+    def fit(self, X: np.ndarray) -> None:
+        ''' trains one 256-word codebook per chunk on at most train_size x 256 random vectors '''
+        if X.shape[1] % self.n_subspaces:
+            raise ValueError(f"Dimension {X.shape[1]} is not divisible into {self.n_subspaces} subspaces")
+        sample_size = self.train_size * 256
+        if len(X) > sample_size:
+            rows = np.random.default_rng(self.random_state).choice(len(X), size=sample_size, replace=False)
+            X = X[np.sort(rows)]
+        chunks = np.asarray(X, dtype=np.float32).reshape(len(X), self.n_subspaces, -1)
+
+        codebooks = []
+        for j in range(self.n_subspaces):
+            kmeans = KMeans(n_clusters=min(256, len(X)), max_iterations=self.max_iterations, dtype=np.float32,
+                            random_state=self.random_state)
+            kmeans.fit(chunks[:, j])
+            codebooks.append(kmeans.centroids)
+        self.codebooks = np.stack(codebooks)
+
+    def encode(self, X: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+        ''' uint8 codes of shape (n, n_subspaces); X may be a memmap, it is read batch_size rows at a time '''
+        codes = np.empty((len(X), self.n_subspaces), dtype=np.uint8)
+        codebook_norms = np.einsum('mkd,mkd->mk', self.codebooks, self.codebooks)
+        for start in range(0, len(X), batch_size):
+            chunks = np.asarray(X[start:start + batch_size], dtype=np.float32).reshape(-1, self.n_subspaces, self.codebooks.shape[2])
+            for j in range(self.n_subspaces):
+                # ‖x‖² is the same for every centroid, so -2xc + ‖c‖² ranks them
+                distances = chunks[:, j] @ self.codebooks[j].T
+                distances *= -2
+                distances += codebook_norms[j]
+                codes[start:start + len(chunks), j] = np.argmin(distances, axis=1)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return self.codebooks[np.arange(self.n_subspaces), codes].reshape(len(codes), -1)
+
+    def lookup_tables(self, queries: np.ndarray, metric: str = 'euclidean') -> np.ndarray:
+        ''' (n_subspaces, 256, n_queries) per-chunk squared distances or inner products to the centroids.
+            Queries are the last axis so that looking up a code reads one contiguous row for all queries. '''
+        chunks = np.asarray(queries, dtype=np.float32).reshape(len(queries), self.n_subspaces, -1)
+        tables = np.einsum('qmd,mkd->mkq', chunks, self.codebooks)
+        if metric == 'euclidean':
+            tables *= -2
+            tables += np.einsum('qmd,qmd->mq', chunks, chunks)[:, np.newaxis, :]
+            tables += np.einsum('mkd,mkd->mk', self.codebooks, self.codebooks)[:, :, np.newaxis]
+            np.maximum(tables, 0, out=tables)
+        elif metric != 'inner_product':
+            raise ValueError(f"Unknown metric: {metric}")
+        return np.ascontiguousarray(tables)
+
+    def table_sums(self, tables: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        ''' (n_codes, n_queries) sums of the looked up table rows '''
+        sums = np.zeros((len(codes), tables.shape[2]), dtype=np.float32)
+        for j in range(self.n_subspaces):
+            sums += tables[j][codes[:, j]]
+        return sums
+
+    def asymmetric_distances(self, queries: np.ndarray, codes: np.ndarray, metric: str = 'euclidean') -> np.ndarray:
+        ''' (n_queries, n_codes) squared distances (or inner products) between exact queries and encoded vectors '''
+        return self.table_sums(self.lookup_tables(queries, metric), codes).T
+
+    def assign(self, codes: np.ndarray, centroids: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+        ''' nearest centroid of every encoded vector, e.g. a KMeans assignment step on compressed data '''
+        tables = self.lookup_tables(centroids)
+        labels = np.empty(len(codes), dtype=np.int64)
+        for start in range(0, len(codes), batch_size):
+            block = codes[start:start + batch_size]
+            labels[start:start + len(block)] = np.argmin(self.table_sums(tables, block), axis=1)
+        return labels
+
+    def radius_neighbors(self, codes: np.ndarray, rows: np.ndarray, radius: float) -> list:
+        ''' DBSCAN-style region query: for every code in rows, the indices of codes within radius.
+            Uses symmetric distances from centroid-to-centroid tables, so neither side is decoded. '''
+        tables = np.stack([
+            np.maximum(np.einsum('kd,kd->k', c, c)[:, np.newaxis] - 2 * c @ c.T + np.einsum('kd,kd->k', c, c), 0)
+            for c in self.codebooks
+        ])
+        distances = np.zeros((len(rows), len(codes)), dtype=np.float32)
+        for j in range(self.n_subspaces):
+            distances += tables[j][codes[rows, j][:, np.newaxis], codes[:, j]]
+        return [np.flatnonzero(row <= radius ** 2) for row in distances]
+
+
+class PQIndex:
+    def __init__(self, n_subspaces: int = 32, block_size: int = 65536):
+        """ Exhaustive inner product search over product-quantized codes, n_subspaces bytes per vector. """
+        self.quantizer = ProductQuantizer(n_subspaces)
+        self.block_size = block_size
+        self.codes = None
+
+    def add(self, vectors: np.ndarray) -> None:
+        if self.quantizer.codebooks is None:
+            self.quantizer.fit(vectors)
+        codes = self.quantizer.encode(vectors)
+        self.codes = codes if self.codes is None else np.vstack([self.codes, codes])
+
+    def search(self, queries: np.ndarray, top_k: int = 5) -> tuple:
+        ''' returns (approximate scores, ids) of shape (n_queries, top_k), best first '''
+        tables = self.quantizer.lookup_tables(queries, metric='inner_product')
+        top_k = min(top_k, len(self.codes))
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, len(self.codes), self.block_size):
+            scores = self.quantizer.table_sums(tables, self.codes[start:start + self.block_size]).T
+            ids = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+            best_scores, best_ids = top_k_merge(
+                np.hstack([best_scores, scores]), np.hstack([best_ids, ids]), top_k
+            )
+        return best_scores, best_ids
+
+    def save(self, path: str) -> None:
+        np.savez(path, kind="pq", codes=self.codes, codebooks=self.quantizer.codebooks, block_size=self.block_size)
+
+
+def load_index(path: str):
+    ''' loads an index written by ExactIndex.save, IVFIndex.save or PQIndex.save '''
+    if not str(path).endswith(".npz"):
+        # np.savez appends the extension the same way
+        path = f"{path}.npz"
+    data = np.load(path, allow_pickle=False)
+    kind = str(data["kind"])
+    if kind == "exact":
+        index = ExactIndex(block_size=int(data["block_size"]))
+        index.vectors = data["vectors"]
+    elif kind == "ivf":
+        centroids = data["centroids"]
+        index = IVFIndex(n_lists=len(centroids), n_probe=int(data["n_probe"]))
+        index.quantizer = KMeans(n_clusters=len(centroids), max_iterations=index.max_iterations, dtype=np.float32)
+        index.quantizer.centroids = centroids
+        index.vectors, index.ids, index.offsets = data["vectors"], data["ids"], data["offsets"]
+    elif kind == "pq":
+        codebooks = data["codebooks"]
+        index = PQIndex(n_subspaces=len(codebooks), block_size=int(data["block_size"]))
+        index.quantizer.codebooks = codebooks
+        index.codes = data["codes"]
+    else:
+        raise ValueError(f"Unknown index kind: {kind}")
+    return index
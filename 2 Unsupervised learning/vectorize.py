@@ -1,55 +1,203 @@
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 from transformers import CLIPProcessor, CLIPModel
 from PIL import Image
 import torch
 
 dataset_path = "../dataset"
+model_name = "openai/clip-vit-base-patch32"
+cache_folder = "cache"
+# fp32 as trained, bf16 halves weights and activations, int8-dynamic quantizes every Linear layer (CPU only)
+precisions = ["fp32", "bf16", "int8-dynamic"]
+# embeddings are flushed to the cache every checkpoint_size images, an interrupted run loses at most that many
+checkpoint_size = 1024
 
-def vectorize_images(images: np.ndarray) -> np.ndarray:
-    vectors = []
-    batch_size = 16
+encoders = {}
+
+def get_encoder(precision: str = "fp32"):
+    ''' CLIP model, processor and device for a precision, loaded once per process and shared by images and texts '''
+    if precision not in precisions:
+        raise ValueError(f"Unknown precision: {precision}")
+    if precision not in encoders:
+        model = CLIPModel.from_pretrained(model_name)
+        processor = CLIPProcessor.from_pretrained(model_name)
+        model.eval()
+        if precision == "int8-dynamic":
+            # weights of the vision and text towers (and projections) become int8, activations are
+            # quantized on the fly; the quantized kernels only exist on CPU
+            device = torch.device("cpu")
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
+            model.to(device, dtype=torch.bfloat16 if precision == "bf16" else torch.float32)
+        encoders[precision] = (model, processor, device)
+    return encoders[precision]
+
+
+def to_model_inputs(inputs: dict, device, precision: str) -> dict:
+    ''' moves processor outputs to the device, float inputs (pixel values) in the model dtype '''
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float32
+    return {k: v.to(device, dtype=dtype) if v.is_floating_point() else v.to(device) for k, v in inputs.items()}
+
+
+def normalize(features) -> np.ndarray:
+    features = features.float()
+    features = features / features.norm(p=2, dim=-1, keepdim=True)
+    return features.cpu().numpy()
+
+
+def image_path(image_name: str) -> str:
+    return f"{dataset_path}/flickr30k_images/{image_name}"
+
+
+def embedding_key(path: str, precision: str = "fp32") -> str:
+    ''' content address of an image embedding: the file, its modification time, the model and its precision '''
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{model_name}"
+    if precision != "fp32":
+        # fp32 keys stay those of caches written before precisions existed
+        key += f"|{precision}"
+    return hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def load_batch(image_names: list, processor) -> dict:
+    ''' decodes and preprocesses one batch of images, closing every file '''
+    batch_images = []
+    for img_path in image_names:
+        with Image.open(image_path(img_path)) as img:
+            batch_images.append(img.convert("RGB"))
+    return processor(images=batch_images, return_tensors="pt", padding=True)
+
+
+def prefetch_batches(images: np.ndarray, batch_size: int, num_workers: int = None, prefetch: int = None,
+                     precision: str = "fp32"):
+    ''' Yields preprocessed batches in order while the next ones are decoded by num_workers threads.
+
+        At most prefetch batches are in flight, which bounds memory. JPEG decoding, resizing and the
+        tensor ops of the model all release the GIL, so threads overlap them without copying batches
+        between processes. '''
+    _, processor, _ = get_encoder(precision)
+    num_workers = num_workers or min(4, os.cpu_count())
+    prefetch = prefetch or 2 * num_workers
+    starts = iter(range(0, len(images), batch_size))
 
-    model_name = "openai/clip-vit-base-patch32"
-    model = CLIPModel.from_pretrained(model_name)
-    processor = CLIPProcessor.from_pretrained(model_name)
+    with ThreadPoolExecutor(num_workers) as pool:
+        pending = deque()
+        try:
+            while True:
+                for start in starts:
+                    pending.append(pool.submit(load_batch, images[start:start + batch_size], processor))
+                    if len(pending) >= prefetch:
+                        break
+                if not pending:
+                    return
+                yield pending.popleft().result()
+        finally:
+            # a consumer that stops early should not wait for batches it will never read
+            for future in pending:
+                future.cancel()
 
-    device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
-    model.to(device)
 
-    for i in range(0, len(images), batch_size):
-        batch_images = images[i:i + batch_size]
-        batch_images = [Image.open(f"{dataset_path}/flickr30k_images/{img_path}") for img_path in batch_images]
-        
-        inputs = processor(images=batch_images, return_tensors="pt", padding=True)
-        inputs = {k: v.to(device) for k, v in inputs.items()}
+def vectorize_image_batches(images: np.ndarray, batch_size: int = 16, num_workers: int = None,
+                            precision: str = "fp32"):
+    ''' yields normalized CLIP embeddings of batch_size images at a time '''
+    model, _, device = get_encoder(precision)
 
+    for inputs in prefetch_batches(images, batch_size, num_workers, precision=precision):
         with torch.no_grad():
-            image_features = model.get_image_features(**inputs)
-            image_features = image_features / image_features.norm(p=2, dim=-1, keepdim=True)
-            vectors.append(image_features.cpu().numpy())
+            yield normalize(model.get_image_features(**to_model_inputs(inputs, device, precision)))
 
-    return np.vstack(vectors)
 
+def vectorize_images(images: np.ndarray, batch_size: int = 16, cache_folder: str = cache_folder,
+                     num_workers: int = None, precision: str = "fp32") -> np.ndarray:
+    ''' Embeds images with CLIP, reusing embeddings stored on disk by earlier runs.
+
+        The store in cache_folder is a flat float32 file of rows plus a JSON index of their embedding_key,
+        so an image is encoded again only if it or the model changed. New rows are appended and the index
+        rewritten every checkpoint_size images, which lets an interrupted run resume where it stopped.
+        cache_folder=None embeds every image. num_workers threads decode images ahead of the model. '''
+    if cache_folder is None:
+        return np.vstack(list(vectorize_image_batches(images, batch_size, num_workers, precision)))
+
+    data_path = os.path.join(cache_folder, "clip_images.f32")
+    index_path = os.path.join(cache_folder, "clip_images.json")
+
+    stored = {"dim": None, "keys": []}
+    if os.path.exists(index_path):
+        with open(index_path, mode='r') as f:
+            stored = json.load(f)
+    rows = {key: i for i, key in enumerate(stored["keys"])}
+
+    keys = [embedding_key(image_path(name), precision) for name in images]
+    missing = {}
+    for key, name in zip(keys, images):
+        if key not in rows and key not in missing:
+            missing[key] = name
+
+    if missing:
+        os.makedirs(cache_folder, exist_ok=True)
+        missing_keys = list(missing)
+        with open(data_path, mode='ab') as data:
+            # the data may run ahead of the index after an interrupted run, drop the rows it never recorded
+            data.truncate(len(stored["keys"]) * (stored["dim"] or 0) * 4)
+
+            for start in range(0, len(missing_keys), checkpoint_size):
+                chunk = missing_keys[start:start + checkpoint_size]
+                embeddings = np.vstack(list(vectorize_image_batches([missing[key] for key in chunk], batch_size, num_workers, precision)))
+                data.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+                data.flush()
+
+                stored = {"dim": embeddings.shape[1], "keys": stored["keys"] + chunk}
+                tmp_path = index_path + ".tmp"
+                with open(tmp_path, mode='w') as f:
+                    json.dump(stored, f)
+                os.replace(tmp_path, index_path)
+        rows = {key: i for i, key in enumerate(stored["keys"])}
 
-def vectorize_text(texts: np.ndarray) -> np.ndarray:
+    embeddings = np.memmap(data_path, dtype=np.float32, mode='r', shape=(len(stored["keys"]), stored["dim"]))
+    return embeddings[[rows[key] for key in keys]]
+
+
+def vectorize_text(texts: np.ndarray, precision: str = "fp32") -> np.ndarray:
     vectors = []
     batch_size = 16
 
-    model_name = "openai/clip-vit-base-patch32"
-    model = CLIPModel.from_pretrained(model_name)
-    processor = CLIPProcessor.from_pretrained(model_name)
-
-    device = torch.device("mps" if torch.backends.mps.is_available() else "cpu")
-    model.to(device)
+    model, processor, device = get_encoder(precision)
 
     for i in range(0, len(texts), batch_size):
         batch_texts = texts[i:i + batch_size]
         inputs = processor(text=batch_texts, return_tensors="pt", padding=True)
-        inputs = {k: v.to(device) for k, v in inputs.items()}
 
         with torch.no_grad():
-            text_features = model.get_text_features(**inputs)
-            text_features = text_features / text_features.norm(p=2, dim=-1, keepdim=True)
-            vectors.append(text_features.cpu().numpy())
+            vectors.append(normalize(model.get_text_features(**to_model_inputs(inputs, device, precision))))
+
+    return np.vstack(vectors)
+
+
+def check_precision(images: np.ndarray, texts: np.ndarray, precision: str = "int8-dynamic") -> dict:
+    ''' Compares embeddings of a small sample at precision against fp32.
+
+        Reports the mean and worst cosine similarity of image and text embeddings to their fp32 versions
+        and how often the best matching image of every text stays the same. '''
+    reference_images = vectorize_images(images, cache_folder=None)
+    reference_texts = vectorize_text(texts)
+    test_images = vectorize_images(images, cache_folder=None, precision=precision)
+    test_texts = vectorize_text(texts, precision=precision)
 
-    return np.vstack(vectors)
\ No newline at end of file
+    image_cosines = np.einsum('ij,ij->i', reference_images, test_images)
+    text_cosines = np.einsum('ij,ij->i', reference_texts, test_texts)
+    top1_agreement = np.mean(
+        np.argmax(reference_texts @ reference_images.T, axis=1) == np.argmax(test_texts @ test_images.T, axis=1)
+    )
+    return {
+        "image_cosine_mean": float(image_cosines.mean()),
+        "image_cosine_min": float(image_cosines.min()),
+        "text_cosine_mean": float(text_cosines.mean()),
+        "text_cosine_min": float(text_cosines.min()),
+        "top1_agreement": float(top1_agreement),
+    }